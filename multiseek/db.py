@@ -0,0 +1,362 @@
+# -*- encoding: utf-8 -*-
+"""Database backend-specific helpers."""
+
+import json
+import re
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connections, transaction, OperationalError, migrations
+from django.db.models import CharField, TextField, IntegerField, \
+    AutoField, Lookup
+from django.db.models.lookups import IContains
+from django.utils.encoding import force_text
+
+try:
+    from django.db.models.sql.datastructures import EmptyResultSet
+except ImportError:
+    from django.core.exceptions import EmptyResultSet
+
+SQLITE_FULL_SCAN = re.compile(r'^SCAN (?:TABLE )?"?(\w+)"?')
+
+# PostgreSQL error code of a statement cancelled because of a timeout
+PG_QUERY_CANCELED = '57014'
+
+# How often (in SQLite virtual machine instructions) should SQLite check,
+# if the statement timeout passed
+SQLITE_PROGRESS_STEPS = 10000
+
+
+# Lookups for matching strings, see StringQueryObject.match
+ILIKE = 'multiseek_ilike'
+FULLTEXT = 'multiseek_fulltext'
+
+# PostgreSQL text search configuration used by the FULLTEXT lookup
+FULLTEXT_CONFIG = getattr(settings, 'MULTISEEK_FULLTEXT_CONFIG', 'simple')
+
+WORD = re.compile(r'\w+', re.UNICODE)
+
+# Lookup for matching long lists of integers, see InListMixin
+IN_VALUES = 'multiseek_in_values'
+
+
+class QueryTimeout(Exception):
+    pass
+
+
+def get_tables(queryset):
+    return set(
+        elem.table_name for elem in queryset.query.alias_map.values())
+
+
+def explain_cost(queryset):
+    """Return an estimated cost of running the queryset, using EXPLAIN.
+
+    For PostgreSQL, this is the total cost of the query plan. SQLite does
+    not estimate costs, so the number of rows of tables, that will be
+    scanned fully, is returned instead. For other database backends,
+    None is returned.
+    """
+    try:
+        sql, params = queryset.query.sql_with_params()
+    except EmptyResultSet:
+        return 0
+
+    connection = connections[queryset.db]
+    cursor = connection.cursor()
+    try:
+        if connection.vendor == 'postgresql':
+            cursor.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+            plan = cursor.fetchone()[0]
+            if isinstance(plan, basestring):
+                plan = json.loads(plan)
+            return plan[0]['Plan']['Total Cost']
+
+        if connection.vendor == 'sqlite':
+            cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+            tables = get_tables(queryset)
+
+            cost = 0
+            for row in cursor.fetchall():
+                match = SQLITE_FULL_SCAN.match(row[-1])
+                if match is None or match.group(1) not in tables:
+                    continue
+
+                # MAX(rowid) is a cheap approximation of COUNT(*)
+                cursor.execute(
+                    'SELECT MAX(rowid) FROM "%s"' % match.group(1))
+                cost += cursor.fetchone()[0] or 0
+            return cost
+    finally:
+        cursor.close()
+
+
+@contextmanager
+def statement_timeout(seconds, using='default'):
+    """Cancel queries run in this block, if they take longer than seconds,
+    raising QueryTimeout.
+
+    On PostgreSQL, SET LOCAL statement_timeout is used, so the block runs
+    in a transaction (or a savepoint). On SQLite, a progress handler
+    interrupts the query. On other database backends, or if seconds is None,
+    queries are not cancelled.
+    """
+    if seconds is None:
+        yield
+        return
+
+    connection = connections[using]
+
+    if connection.vendor == 'postgresql':
+        with transaction.atomic(using=using):
+            cursor = connection.cursor()
+            cursor.execute(
+                "SET LOCAL statement_timeout = %s", [int(seconds * 1000)])
+            try:
+                yield
+            except OperationalError as e:
+                cause = getattr(e, '__cause__', None)
+                if getattr(cause, 'pgcode', None) == PG_QUERY_CANCELED:
+                    raise QueryTimeout(e)
+                raise
+            cursor.execute("SET LOCAL statement_timeout TO DEFAULT")
+
+    elif connection.vendor == 'sqlite':
+        connection.ensure_connection()
+        deadline = time.time() + seconds
+
+        def handler():
+            return time.time() > deadline
+
+        connection.connection.set_progress_handler(
+            handler, SQLITE_PROGRESS_STEPS)
+        try:
+            yield
+        except OperationalError as e:
+            if 'interrupted' in unicode(e):
+                raise QueryTimeout(e)
+            raise
+        finally:
+            connection.connection.set_progress_handler(None, 0)
+
+    else:
+        yield
+
+
+class ILike(Lookup):
+    """Case-insensitive substring match.
+
+    On PostgreSQL this is col ILIKE '%value%', which can use a pg_trgm
+    GIN index on the column (see get_match_index_sql). On other database
+    backends it works like icontains.
+    """
+    lookup_name = ILIKE
+
+    def as_sql(self, compiler, connection):
+        if connection.vendor != 'postgresql':
+            return IContains(self.lhs, self.rhs).as_sql(compiler, connection)
+
+        lhs, params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        rhs_params[0] = "%%%s%%" % connection.ops.prep_for_like_query(
+            rhs_params[0])
+        return '%s ILIKE %s' % (lhs, rhs), params + rhs_params
+
+
+class FullTextMatch(Lookup):
+    """Matches records containing words starting with every word of the
+    value, using a full-text index. Unlike icontains, it does not match
+    substrings inside words and it ignores the order of words and
+    punctuation.
+
+    On PostgreSQL the index is a GIN index on to_tsvector(FULLTEXT_CONFIG,
+    col), on SQLite a FTS5 table (see get_match_index_sql). On other
+    database backends, or if the value has no words, it works like
+    icontains.
+    """
+    lookup_name = FULLTEXT
+
+    def as_sql(self, compiler, connection):
+        words = WORD.findall(force_text(self.rhs or u''))
+        if not words or connection.vendor not in ['postgresql', 'sqlite']:
+            return IContains(self.lhs, self.rhs).as_sql(compiler, connection)
+
+        lhs, params = self.process_lhs(compiler, connection)
+
+        if connection.vendor == 'postgresql':
+            query = u' & '.join(u"%s:*" % word for word in words)
+            return ('to_tsvector(%%s, %s) @@ to_tsquery(%%s, %%s)' % lhs,
+                    [FULLTEXT_CONFIG] + params + [FULLTEXT_CONFIG, query])
+
+        # FTS5 table has the same rowids as the table it indexes
+        model = self.lhs.target.model
+        qn = connection.ops.quote_name
+        table = qn(get_fulltext_table(model, self.lhs.target.column))
+        query = u' '.join(u'"%s"*' % word for word in words)
+        return ('%s.%s IN (SELECT rowid FROM %s WHERE %s MATCH %%s)' % (
+            compiler.quote_name_unless_alias(self.lhs.alias),
+            qn(model._meta.pk.column), table, table), [query])
+
+
+for field in [CharField, TextField]:
+    field.register_lookup(ILike)
+    field.register_lookup(FullTextMatch)
+
+
+class InValues(Lookup):
+    """Matches any of a long list of integers.
+
+    The integers are put in the SQL as literals, so the statement does not
+    hit the limit of query parameters (999 on SQLite). On PostgreSQL the
+    list is written as col IN (VALUES (1), (2), ...), which the planner
+    treats like a (hashed) join with a table, not as a long chain of
+    comparisons.
+    """
+    lookup_name = IN_VALUES
+
+    def get_prep_lookup(self):
+        return [int(self.lhs.output_field.get_prep_value(value))
+                for value in self.rhs]
+
+    def as_sql(self, compiler, connection):
+        if not self.rhs:
+            raise EmptyResultSet
+
+        lhs, params = self.process_lhs(compiler, connection)
+        if connection.vendor == 'postgresql':
+            values = u'VALUES %s' % u', '.join(
+                u'(%i)' % value for value in self.rhs)
+        else:
+            values = u', '.join(u'%i' % value for value in self.rhs)
+        return '%s IN (%s)' % (lhs, values), params
+
+
+for field in [IntegerField, AutoField]:
+    field.register_lookup(InValues)
+
+
+def relevance_sql(model, column, value, lookup, connection):
+    """Return SQL (and its parameters) of an expression ranking how well
+    a column of the model matches a searched value, for ordering by
+    relevance. The higher, the better.
+
+    :param lookup: lookup used to search the column (ILIKE, FULLTEXT or
+    other), so the rank can use the same index: pg_trgm similarity or
+    ts_rank on PostgreSQL, bm25 of the FTS5 table on SQLite. Otherwise
+    equal values rank above values starting with the searched one, which
+    rank above other values.
+    """
+    qn = connection.ops.quote_name
+    table = qn(model._meta.db_table)
+    col = '%s.%s' % (table, qn(column))
+    value = force_text(value)
+    words = WORD.findall(value)
+
+    if connection.vendor == 'postgresql':
+        if lookup == ILIKE:
+            return 'similarity(%s, %%s)' % col, [value]
+        if lookup == FULLTEXT and words:
+            query = u' | '.join(u"%s:*" % word for word in words)
+            return ('ts_rank(to_tsvector(%%s, %s), to_tsquery(%%s, %%s))'
+                    % col, [FULLTEXT_CONFIG, FULLTEXT_CONFIG, query])
+
+    elif connection.vendor == 'sqlite' and lookup == FULLTEXT and words:
+        # bm25 is lower for better matches
+        fts = qn(get_fulltext_table(model, column))
+        query = u' OR '.join(u'"%s"*' % word for word in words)
+        return ('COALESCE((SELECT -bm25(%s) FROM %s WHERE %s MATCH %%s '
+                'AND rowid = %s.%s), 0)' % (
+                    fts, fts, fts, table, qn(model._meta.pk.column)),
+                [query])
+
+    return ('CASE WHEN %s = %%s THEN 2 WHEN %s %s THEN 1 ELSE 0 END' % (
+        col, col, connection.operators['startswith'] % '%s'),
+        [value, connection.ops.prep_for_like_query(value) + u'%'])
+
+
+def get_fulltext_table(model, column):
+    return '%s_%s_fts' % (model._meta.db_table, column)
+
+
+def get_match_index_sql(model, field_name, lookup, connection):
+    """Return a tuple of lists of SQL statements, creating and dropping an
+    index for matching the field with a lookup (ILIKE or FULLTEXT) on the
+    database connection. For lookups or database backends, that can't use
+    an index, both lists are empty.
+    """
+    qn = connection.ops.quote_name
+    table = model._meta.db_table
+    column = model._meta.get_field(field_name).column
+    index = 'multiseek_%s_%s_%s' % (table, column, lookup.split('_')[-1])
+
+    if connection.vendor == 'postgresql':
+        if lookup == ILIKE:
+            return ([
+                "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+                "CREATE INDEX %s ON %s USING gin (%s gin_trgm_ops)" % (
+                    qn(index), qn(table), qn(column))
+            ], [
+                "DROP INDEX IF EXISTS %s" % qn(index)
+            ])
+
+        if lookup == FULLTEXT:
+            return ([
+                "CREATE INDEX %s ON %s USING gin (to_tsvector('%s', %s))" % (
+                    qn(index), qn(table), FULLTEXT_CONFIG, qn(column))
+            ], [
+                "DROP INDEX IF EXISTS %s" % qn(index)
+            ])
+
+    if connection.vendor == 'sqlite' and lookup == FULLTEXT:
+        fts = get_fulltext_table(model, column)
+        values = dict(
+            fts=qn(fts), table=qn(table), column=qn(column),
+            pk=qn(model._meta.pk.column),
+            insert=qn(fts + '_insert'), delete=qn(fts + '_delete'),
+            update=qn(fts + '_update'))
+
+        # External content FTS5 table, kept up to date with triggers
+        return ([
+            "CREATE VIRTUAL TABLE %(fts)s USING fts5(%(column)s, "
+            "content=%(table)s, content_rowid=%(pk)s)" % values,
+            "INSERT INTO %(fts)s(%(fts)s) VALUES ('rebuild')" % values,
+            "CREATE TRIGGER %(insert)s AFTER INSERT ON %(table)s BEGIN "
+            "INSERT INTO %(fts)s(rowid, %(column)s) "
+            "VALUES (new.%(pk)s, new.%(column)s); END" % values,
+            "CREATE TRIGGER %(delete)s AFTER DELETE ON %(table)s BEGIN "
+            "INSERT INTO %(fts)s(%(fts)s, rowid, %(column)s) "
+            "VALUES ('delete', old.%(pk)s, old.%(column)s); END" % values,
+            "CREATE TRIGGER %(update)s AFTER UPDATE ON %(table)s BEGIN "
+            "INSERT INTO %(fts)s(%(fts)s, rowid, %(column)s) "
+            "VALUES ('delete', old.%(pk)s, old.%(column)s); "
+            "INSERT INTO %(fts)s(rowid, %(column)s) "
+            "VALUES (new.%(pk)s, new.%(column)s); END" % values,
+        ], [
+            "DROP TRIGGER IF EXISTS %(insert)s" % values,
+            "DROP TRIGGER IF EXISTS %(delete)s" % values,
+            "DROP TRIGGER IF EXISTS %(update)s" % values,
+            "DROP TABLE IF EXISTS %(fts)s" % values,
+        ])
+
+    return [], []
+
+
+def match_index_operation(app_label, model_name, field_name, lookup):
+    """Return a migration operation creating an index for matching
+    the field with a lookup, see get_match_index_sql."""
+
+    def run(apps, schema_editor, drop=False):
+        model = apps.get_model(app_label, model_name)
+        sql = get_match_index_sql(
+            model, field_name, lookup, schema_editor.connection)[drop]
+        for statement in sql:
+            schema_editor.execute(statement)
+
+    def forwards(apps, schema_editor):
+        run(apps, schema_editor)
+
+    def backwards(apps, schema_editor):
+        run(apps, schema_editor, drop=True)
+
+    return migrations.RunPython(forwards, backwards)
@@ -0,0 +1,89 @@
+# -*- encoding: utf-8 -*-
+import time
+from contextlib import contextmanager
+
+from django.db import connection
+
+from multiseek.signals import search_phase, search_event
+
+PARSE = 'parse'
+COMPILE = 'compile'
+EXPLAIN = 'explain'
+EXECUTE = 'execute'
+FACETS = 'facets'
+RENDER = 'render'
+
+TIMEOUT = 'timeout'
+
+
+def query_count():
+    """Return the number of queries logged by the default database
+    connection, or None if queries are not logged (settings.DEBUG is
+    False and the debug cursor is not forced)."""
+    if hasattr(connection, 'queries_logged'):
+        # Django 1.8
+        if not connection.queries_logged:
+            return
+        return len(connection.queries_log)
+
+    # Django 1.7
+    if not connection.use_debug_cursor:
+        from django.conf import settings
+        if not settings.DEBUG:
+            return
+    return len(connection.queries)
+
+
+class SearchTimings(object):
+    """Measures phases of a search (parsing form data, building the query,
+    running it, rendering the results...). Every phase is reported via
+    multiseek.signals.search_phase as soon as it ends and collected, so
+    a summary can be returned to the client.
+    """
+
+    def __init__(self, sender, request=None):
+        self.sender = sender
+        self.request = request
+        self.phases = []
+        self.events = []
+
+    @contextmanager
+    def phase(self, name):
+        queries = query_count()
+        start = time.time()
+        try:
+            yield
+        finally:
+            duration = time.time() - start
+            if queries is not None:
+                queries = query_count() - queries
+
+            self.phases.append((name, duration, queries))
+            search_phase.send(
+                sender=self.sender, phase=name, duration=duration,
+                queries=queries, request=self.request)
+
+    def event(self, name):
+        """Count an event, like a query cancelled because of a timeout."""
+        self.events.append(name)
+        search_event.send(sender=self.sender, event=name, request=self.request)
+
+    def total(self, name):
+        """Return total duration of all phases called name, in seconds."""
+        return sum(duration for phase, duration, queries in self.phases
+                   if phase == name)
+
+    def as_server_timing(self):
+        """Return a summary of phases as a value of Server-Timing HTTP
+        header, which is displayed by browser developer tools."""
+        ret = []
+        for name, duration, queries in self.phases:
+            elem = '%s;dur=%.2f' % (name, duration * 1000.0)
+            if queries is not None:
+                elem += ';desc="%i queries"' % queries
+            ret.append(elem)
+
+        for name in sorted(set(self.events)):
+            ret.append('%s;desc="%i"' % (name, self.events.count(name)))
+
+        return ", ".join(ret)
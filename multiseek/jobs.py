@@ -0,0 +1,150 @@
+# -*- encoding: utf-8 -*-
+"""Running searches in the background.
+
+A search job stores primary keys of matching records in the cache, in pages
+of JOB_PAGE_SIZE records, so the results can be displayed as soon as the
+first pages are ready. Jobs are run by a job runner: by default, by
+ThreadJobRunner, in threads of the web server process. To use a task queue,
+set MULTISEEK_JOB_RUNNER to a dotted path of an object with a
+submit(function, *args) method, which will call function(*args) somewhere
+else. The cache must then be shared between processes.
+"""
+
+import logging
+import threading
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.utils.module_loading import import_string
+from django.utils.six.moves import queue
+
+logger = logging.getLogger(__name__)
+
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+JOB_PAGE_SIZE = getattr(settings, 'MULTISEEK_JOB_PAGE_SIZE', 100)
+JOB_TIMEOUT = getattr(settings, 'MULTISEEK_JOB_TIMEOUT', 3600)
+JOB_MAX_WORKERS = getattr(settings, 'MULTISEEK_JOB_MAX_WORKERS', 4)
+
+JOB_CACHE_KEY = 'multiseek_job_%s'
+JOB_PAGE_CACHE_KEY = 'multiseek_job_%s_%i'
+
+
+class ThreadJobRunner(object):
+    """Runs jobs in a pool of max_workers threads of the current process,
+    started with the first job; other jobs wait in a queue for their
+    turn."""
+
+    def __init__(self, max_workers=JOB_MAX_WORKERS):
+        self.max_workers = max_workers
+        self.queue = queue.Queue()
+        self.workers = []
+        self.lock = threading.Lock()
+
+    def run(self, function, *args):
+        try:
+            function(*args)
+        finally:
+            # Every thread gets its own database connection
+            connection.close()
+
+    def work(self):
+        while True:
+            function, args = self.queue.get()
+            try:
+                self.run(function, *args)
+            except Exception:
+                logger.exception("Background job %r failed", function)
+            finally:
+                self.queue.task_done()
+
+    def start_workers(self):
+        with self.lock:
+            while len(self.workers) < self.max_workers:
+                thread = threading.Thread(target=self.work)
+                thread.daemon = True
+                thread.start()
+                self.workers.append(thread)
+
+    def submit(self, function, *args):
+        self.start_workers()
+        self.queue.put((function, args))
+
+
+_runner = None
+
+
+def get_job_runner():
+    global _runner
+    if _runner is None:
+        runner = getattr(settings, 'MULTISEEK_JOB_RUNNER', None)
+        if runner is None:
+            _runner = ThreadJobRunner()
+        else:
+            _runner = import_string(runner)
+    return _runner
+
+
+def set_job(job_id, status, count=0, pages=0):
+    job = dict(id=job_id, status=status, count=count, pages=pages)
+    cache.set(JOB_CACHE_KEY % job_id, job, JOB_TIMEOUT)
+    return job
+
+
+def get_job(job_id):
+    """Return a dict with job id, status (RUNNING, DONE or FAILED), count
+    of records found so far and number of pages ready, or None if there is
+    no such job."""
+    return cache.get(JOB_CACHE_KEY % job_id)
+
+
+def get_job_page(job_id, no):
+    """Return a list of primary keys on page no (counting from zero), or
+    None if the page is not ready."""
+    return cache.get(JOB_PAGE_CACHE_KEY % (job_id, no))
+
+
+def run_search(job_id, model, query):
+    """Find primary keys of records matching the query, storing them
+    page by page."""
+    queryset = model._default_manager.all()
+    queryset.query = query
+
+    count = pages = 0
+    page = []
+
+    def flush():
+        cache.set(JOB_PAGE_CACHE_KEY % (job_id, pages), page, JOB_TIMEOUT)
+        return set_job(job_id, RUNNING, count, pages + 1)
+
+    try:
+        for pk in queryset.values_list('pk', flat=True).iterator():
+            page.append(pk)
+            count += 1
+            if len(page) == JOB_PAGE_SIZE:
+                flush()
+                pages += 1
+                page = []
+
+        if page:
+            flush()
+            pages += 1
+
+    except Exception:
+        logger.exception("Search job %s failed", job_id)
+        set_job(job_id, FAILED, count, pages)
+        return
+
+    set_job(job_id, DONE, count, pages)
+
+
+def start_search(queryset):
+    """Run the queryset in the background, return the job."""
+    job = set_job(uuid4().hex, RUNNING)
+    get_job_runner().submit(run_search, job['id'], queryset.model,
+                            queryset.query)
+    return job
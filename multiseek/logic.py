@@ -1,14 +1,21 @@
 # -*- encoding: utf-8 -*-
 from decimal import Decimal
 import decimal
+import hashlib
 import importlib
 
 import json
+import logging
 import re
-from datetime import timedelta
+import unicodedata
+from datetime import timedelta, datetime, time
 from dateutil.parser import parse
-from django.db.models import Q
-from django.utils import html
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist
+from django.db import connections
+from django.db.models import Q, Count
+from django.utils import html, timezone
+from django.utils.encoding import force_text
 try:
     from django.db.models.options import get_verbose_name
 except ImportError:
@@ -16,9 +23,38 @@ except ImportError:
 from django.utils.translation import ugettext_lazy as _
 from collections import namedtuple
 
+from multiseek.db import explain_cost, ILIKE, FULLTEXT, IN_VALUES, \
+    relevance_sql
+
+logger = logging.getLogger(__name__)
+
 MULTISEEK_REPORT_TYPE = '_ms_report_type'
 MULTISEEK_ORDERING_PREFIX = "order_"
 
+# Version of the normalized form data format, see
+# MultiseekRegistry.normalize_form
+FORM_SCHEMA_VERSION = 1
+
+# How many queries will MultiseekRegistry.get_cached_query keep
+QUERY_CACHE_SIZE = 128
+
+# What to do with searches exceeding MultiseekRegistry.max_query_cost:
+COST_REFUSE = "refuse"  # don't run them at all
+COST_LIMIT = "limit"  # return at most query_cost_row_limit records
+COST_BACKGROUND = "background"  # run them in background, see multiseek.jobs
+
+# How are fields traversing relations joined, see
+# MultiseekRegistry.get_join_strategy:
+JOIN = "join"  # with a plain join
+SEMI_JOIN = "semi-join"  # with a pk__in subquery, for multi-valued relations
+
+# How can StringQueryObject match strings for CONTAINS and NOT_CONTAINS:
+MATCH_ICONTAINS = "icontains"  # with LIKE; can't use an index
+MATCH_TRIGRAM = ILIKE  # with ILIKE, using a pg_trgm index on PostgreSQL
+# by word prefixes, using a full-text index. This changes what CONTAINS
+# means: u"ook" no longer finds u"book", u"bo ti" finds u"book title"
+MATCH_FULLTEXT = FULLTEXT
+
 AND = "and"
 OR = "or"
 ANDNOT = "andnot"
@@ -71,6 +107,14 @@ NOT_STARTS_WITH = _("not starts with")  # u"nie zaczyna się od"
 IN_RANGE = _("in range")              # u'zawiera się w'
 NOT_IN_RANGE = _("outside range")      # u'nie zawiera się w'
 
+IN_LIST = _("in list")  # u'na liście'
+NOT_IN_LIST = _("not in list")  # u'nie na liście'
+IN_LIST_OPS = [IN_LIST, NOT_IN_LIST]
+
+# Lists longer than that are matched with IN (VALUES ...), see
+# multiseek.db.InValues
+IN_LIST_THRESHOLD = getattr(settings, 'MULTISEEK_IN_LIST_THRESHOLD', 500)
+
 STRING_OPS = [CONTAINS, NOT_CONTAINS,
               EQUAL, DIFFERENT,
               STARTS_WITH, NOT_STARTS_WITH]
@@ -100,6 +144,46 @@ class UnknownOperation(Exception):
     pass
 
 
+def parse_in_list(value):
+    """Return a sorted list of unique integers from a pasted list, like
+    u"1, 2 3;4", for IN_LIST operation."""
+    return sorted(set(
+        int(x) for x in re.findall(r'(?<!\d)-?\d+', value or u'')))
+
+
+class InListMixin(object):
+    """Adds IN_LIST and NOT_IN_LIST operations, matching any of many
+    integers pasted by the user, with a single query."""
+
+    # Field used to match the integers
+    in_list_field_name = None
+
+    def get_in_list_field_name(self):
+        return self.in_list_field_name or self.field_name
+
+    def query_for(self, value, operation):
+        if operation in IN_LIST_OPS:
+            return self.in_list_query(parse_in_list(value), operation)
+        return super(InListMixin, self).query_for(value, operation)
+
+    def in_list_query(self, values, operation):
+        lookup = "__in"
+        if len(values) > IN_LIST_THRESHOLD:
+            lookup = "__" + IN_VALUES
+
+        ret = Q(**{self.get_in_list_field_name() + lookup: values})
+        if operation == NOT_IN_LIST:
+            return ~ret
+        return ret
+
+    def value_for_description(self, value):
+        ret = super(InListMixin, self).value_for_description(value)
+        if ret is None and isinstance(value, basestring):
+            # A list, for IN_LIST
+            return u", ".join(unicode(x) for x in parse_in_list(value))
+        return ret
+
+
 class UnknownField(Exception):
     pass
 
@@ -204,6 +288,45 @@ class StringQueryObject(QueryObject):
     ops = STRING_OPS
     empty_value_description = _("(empty)")
 
+    # One of MATCH_* constants. MATCH_TRIGRAM finds the same records as
+    # MATCH_ICONTAINS; MATCH_FULLTEXT is opt-in, as it matches word
+    # prefixes instead of substrings. To create indexes for MATCH_TRIGRAM
+    # and MATCH_FULLTEXT, run multiseek_match_indexes management command or
+    # use multiseek.db.match_index_operation in a migration.
+    match = MATCH_ICONTAINS
+
+    # Name of a model field, holding normalize_string(field_name) value.
+    # If set, the search term is normalized too, and every operation
+    # matches that field instead, so searching is case- and
+    # accent-insensitive. STARTS_WITH can then use an index of that field
+    # (on PostgreSQL, with "C" collation). The value is updated when saving
+    # records, see multiseek.models.connect_registry_signals.
+    normalized_field_name = None
+
+    def __init__(self, field_name=None, label=None, public=None,
+                 match=None, normalized_field_name=None):
+        super(StringQueryObject, self).__init__(
+            field_name, label, public=public)
+
+        if match is not None:
+            self.match = match
+
+        if normalized_field_name is not None:
+            self.normalized_field_name = normalized_field_name
+
+    def get_matched_field_name(self):
+        """Returns the name of the model field, which is matched by every
+        operation and needs match indexes (see
+        multiseek.db.get_match_index_sql)."""
+        return self.normalized_field_name or self.field_name
+
+    def normalize_record(self, instance):
+        """Update the normalized field of a model instance."""
+        if self.normalized_field_name is None:
+            return
+        setattr(instance, self.normalized_field_name,
+                normalize_string(getattr(instance, self.field_name)))
+
     def impacts_query(self, operator, value):
         if operator in [CONTAINS, NOT_CONTAINS, STARTS_WITH, NOT_STARTS_WITH] \
                 and not value:
@@ -211,42 +334,53 @@ class StringQueryObject(QueryObject):
         return True
 
     def value_from_web(self, value):
+        if self.normalized_field_name is not None:
+            return normalize_string(value)
         return value.encode('utf-8')
 
     def value_for_description(self, value):
-        value = super(StringQueryObject, self).value_for_description(value)
         if not value:
             return self.empty_value_description
         return u'"%s"' % html.escape(value)
 
     def real_query(self, value, operation):
-        ret = QueryObject.real_query(
-            self, value, operation, validate_operation=False)
+        # Value of normalized field was normalized by value_from_web
+        field_name = self.get_matched_field_name()
 
-        if ret is not None:
-            return ret
+        if operation in EQUALITY_OPS_ALL:
+            ret = Q(**{field_name: value})
 
         elif operation in [CONTAINS, NOT_CONTAINS]:
-            ret = Q(**{self.field_name + "__icontains": value})
+            ret = Q(**{field_name + "__" + self.match: value})
 
         elif operation in [STARTS_WITH, NOT_STARTS_WITH]:
-            ret = Q(**{self.field_name + "__startswith": value})
+            if self.normalized_field_name is not None and value:
+                ret = Q(**{field_name + "__gte": value,
+                           field_name + "__lt": get_prefix_end(value)})
+            else:
+                ret = Q(**{field_name + "__startswith": value})
 
         else:
             raise UnknownOperation(operation)
 
-        if operation in [NOT_CONTAINS, NOT_STARTS_WITH]:
+        if operation in DIFFERENT_ALL or \
+                operation in [NOT_CONTAINS, NOT_STARTS_WITH]:
             return ~ret
 
         return ret
 
 
-class AutocompleteQueryObject(QueryObject):
+class AutocompleteQueryObject(InListMixin, QueryObject):
     type = AUTOCOMPLETE
-    ops = EQUALITY_OPS_MALE
+    ops = EQUALITY_OPS_MALE + IN_LIST_OPS
     model = None
     url = None
 
+    # Names of fields of the model, holding normalize_string values of
+    # search_fields, in the same order. If set, autocompletion is case-
+    # and accent-insensitive and can use (trigram) indexes of those fields.
+    normalized_search_fields = None
+
     def __init__(
             self, field_name=None, label=None, model=None, url=None,
             public=None):
@@ -260,6 +394,9 @@ class AutocompleteQueryObject(QueryObject):
         if url is not None:
             self.url = url
 
+    def get_in_list_field_name(self):
+        return self.in_list_field_name or self.field_name + "__pk"
+
     def get_url(self):
         if self.url:
             return self.url
@@ -290,6 +427,13 @@ class AutocompleteQueryObject(QueryObject):
             return json.dumps([None, ''])
         return json.dumps([value, self.get_label(model)])
 
+    def normalize_record(self, instance):
+        """Update normalized search fields of a model instance."""
+        for field, normalized in zip(self.search_fields,
+                                     self.normalized_search_fields or []):
+            setattr(instance, normalized,
+                    normalize_string(getattr(instance, field)))
+
     def get_autocomplete_query(self, data):
         """This function should return an iterable, like a QuerySet. This
          iterable, in turn, will be used by JQuery UI widget on the web.
@@ -297,15 +441,22 @@ class AutocompleteQueryObject(QueryObject):
         :param data: string passed from web request.
         """
 
+        search_fields = self.search_fields
+        lookup = "__icontains"
+        if self.normalized_search_fields:
+            search_fields = self.normalized_search_fields
+            lookup = "__contains"
+            data = normalize_string(data)
+
         def args(fld, elem):
-            return {fld + "__icontains": elem}
+            return {fld + lookup: elem}
 
         if data:
             # split by comma, space, etc.
             data = data.split(" ")
 
-            ret = Q(**args(self.search_fields[0], data[0]))
-            for f, v in zip(self.search_fields[1:], data[1:]):
+            ret = Q(**args(search_fields[0], data[0]))
+            for f, v in zip(search_fields[1:], data[1:]):
                 ret = ret & Q(**args(f, v))
             return self.model.objects.filter(ret)
 
@@ -321,35 +472,74 @@ class DateQueryObject(QueryObject):
     type = DATE
     ops = DATE_OPS
 
+    # Set to True for DateTimeFields, so days start at midnight of
+    # the current time zone
+    is_datetime = False
+
     def value_from_web(self, value):
         value = json.loads(value)
         if len(value) == 1:
             return parse(value[0]).date()
         return [parse(value[0]).date(), parse(value[1]).date()]
 
-    def real_query(self, value, operation):
-        if operation in RANGE_OPS:
-            ret = Q(**{self.field_name + '__gte': value[0],
-                       self.field_name + '__lte': value[1]})
+    def get_bounds(self, value, operation):
+        """Return (start, end) tuple of dates, so that records matching the
+        value and the operation are start <= record < end. None means
+        no bound. Return None for operations, which exclude a range of
+        dates (DIFFERENT, NOT_IN_RANGE).
+        """
+        day = timedelta(days=1)
+
+        if operation in DIFFERENT_ALL or operation == RANGE_OPS[1]:
+            return
+        elif operation == RANGE_OPS[0]:
+            return value[0], value[1] + day
         elif operation in EQUALITY_OPS_ALL:
-            return Q(**{self.field_name + "__range": (value, value + timedelta(days=1))})
-        elif operation in DIFFERENT_ALL:
-            return ~Q(**{self.field_name + "__range": (value, value + timedelta(days=1))})
+            return value, value + day
         elif operation in GREATER_OPS_ALL:
-            return Q(**{self.field_name + "__gt": value})
+            return value + day, None
         elif operation in LESSER_OPS_ALL:
-            return Q(**{self.field_name + "__lt": value})
+            return None, value
         elif operation in GREATER_OR_EQUAL_OPS_ALL:
-            return Q(**{self.field_name + "__gte": value})
+            return value, None
         elif operation in LESSER_OR_EQUAL_OPS_ALL:
-            return Q(**{self.field_name + "__lte": value})
-        else:
-            raise UnknownOperation(operation)
+            return None, value + day
 
-        if operation == RANGE_OPS[1]:
-            return ~ret
+        raise UnknownOperation(operation)
 
-        return ret
+    def to_boundary(self, value):
+        """Return a value to compare the field with, for a date."""
+        if not self.is_datetime:
+            return value
+
+        value = datetime.combine(value, time())
+        if settings.USE_TZ:
+            value = timezone.make_aware(
+                value, timezone.get_current_timezone())
+        return value
+
+    def bounds_query(self, start, end):
+        """Return a query for start <= field < end."""
+        kwargs = {}
+        if start is not None:
+            kwargs[self.field_name + '__gte'] = self.to_boundary(start)
+        if end is not None:
+            kwargs[self.field_name + '__lt'] = self.to_boundary(end)
+        return Q(**kwargs)
+
+    def real_query(self, value, operation):
+        bounds = self.get_bounds(value, operation)
+        if bounds is not None:
+            return self.bounds_query(*bounds)
+
+        if operation in DIFFERENT_ALL:
+            start, end = self.get_bounds(value, EQUAL)
+        else:
+            start, end = self.get_bounds(value, RANGE_OPS[0])
+
+        return Q(**{self.field_name + '__lt': self.to_boundary(start)}) | \
+            Q(**{self.field_name + '__gte': self.to_boundary(end)}) | \
+            Q(**{self.field_name + '__isnull': True})
 
 
 class RangeQueryObject(QueryObject):
@@ -417,8 +607,9 @@ class AbstractNumberQueryObject(QueryObject):
             raise UnknownOperation(operation)
 
 
-class IntegerQueryObject(AbstractNumberQueryObject):
+class IntegerQueryObject(InListMixin, AbstractNumberQueryObject):
     type = INTEGER
+    ops = AbstractNumberQueryObject.ops + IN_LIST_OPS
 
     def value_from_web(self, value):
         try:
@@ -438,21 +629,36 @@ class DecimalQueryObject(AbstractNumberQueryObject):
 
 
 
-class ValueListQueryObject(QueryObject):
+class FacetMixin(object):
+    # If True, the results page shows how many results have every value
+    # of this field, see MultiseekRegistry.get_facets
+    facet = False
+
+    def facet_label(self, value):
+        """Return a label of a value of the field, as stored in the
+        database, for facet counts."""
+        return unicode(value)
+
+
+class ValueListQueryObject(FacetMixin, QueryObject):
     type = VALUE_LIST
     ops = [EQUAL, DIFFERENT]
     values = None
 
-    def __init__(self, field_name=None, label=None, values=None, public=None):
+    def __init__(self, field_name=None, label=None, values=None, public=None,
+                 facet=None):
         super(ValueListQueryObject, self).__init__(
             field_name, label, public=public)
         if values is not None:
             self.values = values
 
+        if facet is not None:
+            self.facet = facet
+
 BOOLEAN_TRUE_LABEL = _("yes")
 BOOLEAN_FALSE_LABEL = _("no")
 
-class BooleanQueryObject(QueryObject):
+class BooleanQueryObject(FacetMixin, QueryObject):
     type = VALUE_LIST
     ops = [EQUAL, DIFFERENT]
 
@@ -471,27 +677,135 @@ class BooleanQueryObject(QueryObject):
     def value_for_description(self, value):
         return value
 
+    def facet_label(self, value):
+        if value is None:
+            return None
+        return unicode(self.true_label if value else self.false_label)
+
 Ordering = namedtuple("Ordering", ["field", "label"])
 
+# Use as a field of an Ordering to sort the best matches of text
+# searches first, see MultiseekRegistry.get_relevance
+RELEVANCE = "multiseek_relevance"
+
 
 class ReportType(namedtuple("ReportType", "id label public")):
     def __new__(cls, id, label, public=True):
         return super(ReportType, cls).__new__(cls, id, label, public)
 
 
-class _FrameInfo:
-    frame = None
-    field = None
-
-    def __init__(self, frame=-1, field=0):
-        self.frame = frame
-        self.field = field
-
 def get_ordering_key_name(no):
     key = "%s%s" % (MULTISEEK_ORDERING_PREFIX, no)
     key_dir = key + "_dir"
     return key, key_dir
 
+def get_query_hash(data):
+    """Return a hash of the query part of a normalized form, which can be
+    used as a cache key for things depending on the query.
+    """
+    return hashlib.sha1(
+        json.dumps(data.get('form_data'), sort_keys=True)).hexdigest()
+
+
+# Letters, which are not decomposed to a base letter and an accent by
+# Unicode normalization
+NORMALIZED_LETTERS = {
+    ord(u'ł'): u'l',
+    ord(u'đ'): u'd',
+    ord(u'ø'): u'o',
+}
+
+
+def is_multi_valued(model, field_name):
+    """Returns True if a lookup path (like "authors__last_name") from
+    the model traverses a multi-valued relation."""
+    if model is None:
+        return False
+
+    for name in field_name.split('__'):
+        try:
+            # (field, model, direct, m2m)
+            info = model._meta.get_field_by_name(name)
+        except FieldDoesNotExist:
+            # A lookup, like "year" in "last_updated__year"
+            return False
+
+        field, direct, m2m = info[0], info[2], info[3]
+        if m2m:
+            return True
+
+        if direct:
+            if getattr(field, 'rel', None) is None:
+                return False
+            model = field.rel.to
+            continue
+
+        # Reverse relation; only a reverse one-to-one is single-valued
+        if not field.field.unique:
+            return True
+        model = getattr(field, 'related_model', None) or field.model
+
+    return False
+
+
+def is_indexed(model, field_name):
+    """Returns True if the database can use an index of the model to sort
+    records by field_name (as passed to QuerySet.order_by)."""
+    if model is None or "__" in field_name:
+        # Sorting by a field of a related model needs a join first
+        return False
+
+    try:
+        # (field, model, direct, m2m)
+        info = model._meta.get_field_by_name(field_name.lstrip('-'))
+    except FieldDoesNotExist:
+        # Not a field, like RELEVANCE
+        return False
+
+    field, direct, m2m = info[0], info[2], info[3]
+    if not direct or m2m:
+        return False
+
+    rel = getattr(field, 'rel', None)
+    if rel is not None and rel.to._meta.ordering:
+        # Sorted by the ordering of the related model
+        return False
+
+    if field.primary_key or field.unique or field.db_index:
+        return True
+
+    # Index of many fields can be used, if it starts with the field
+    return any(fields[0] == field.name
+               for fields in model._meta.index_together)
+
+
+def combine_bounds(a, b, function):
+    """Return function(a, b) of range bounds, where None means no bound."""
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return function(a, b)
+
+
+def normalize_string(value):
+    """Return a lowercased value without accents (u"Żółw" becomes
+    u"zolw"), as stored in normalized (shadow) columns, see
+    StringQueryObject.normalized_field_name."""
+    if value is None:
+        return None
+    value = unicodedata.normalize('NFKD', force_text(value).lower())
+    return u''.join(
+        char for char in value if not unicodedata.combining(char)
+    ).translate(NORMALIZED_LETTERS)
+
+
+def get_prefix_end(prefix):
+    """Return the smallest string greater than every string starting with
+    prefix, so prefix search can be done with prefix <= x < prefix end."""
+    return prefix[:-1] + unichr(ord(prefix[-1]) + 1)
+
+
 class MultiseekRegistry:
     """This is a base class for multiseek registry. A registry is a list
     of registered fields, that will be used to render the multiseek form
@@ -510,11 +824,55 @@ class MultiseekRegistry:
     report_types = None
     default_ordering = None
 
+    # Searches running longer than this number of seconds will be logged
+    # (see multiseek.models.SlowSearch). None disables the log.
+    slow_search_threshold = None
+
+    # Searches with estimated cost (see multiseek.db.explain_cost) higher
+    # than max_query_cost will be refused or limited, depending on
+    # query_cost_action. None disables the check.
+    max_query_cost = None
+    query_cost_action = COST_REFUSE
+    query_cost_row_limit = 1000
+
+    # Queries running longer than this number of seconds will be cancelled
+    # (see multiseek.db.statement_timeout). None disables the timeout.
+    statement_timeout = None
+
+    # Number of records on a page of results. The results page queries
+    # only for them (and one more, to know if there is a next page).
+    page_size = 100
+
+    # If True, numbers of records for every value of facet fields are
+    # stored (see multiseek.models.FacetCount) and updated on every change
+    # of the records, so facets of searches without conditions don't need
+    # to count all the records
+    facet_rollup = False
+
+    # If True, rendered rows of results are cached (see
+    # MultiseekResults.render_rows) until the record changes
+    cache_rows = False
+
+    # If True, results pages get an ETag, so browsers can reload them with
+    # a conditional GET, answered with 304 Not Modified if neither the
+    # search nor the records changed. Records must be changed with signal
+    # handlers connected with multiseek.models.connect_registry_signals.
+    etag = False
+
+    # Results sorted by RELEVANCE are limited to this number of the best
+    # matching records, so the database needs to keep only them while
+    # sorting.
+    relevance_row_limit = 1000
+
     def __init__(self):
         self.fields = []
         self.field_by_name = {}
+        self.autocomplete_by_model = {}
         self.default_ordering = {}
         self.report_types = []
+        self.query_cache = {}
+        self.multi_valued = {}
+        self.indexed = {}
 
     def set_default_ordering(self, *args):
         self.default_ordering = {}
@@ -545,6 +903,13 @@ class MultiseekRegistry:
             if unicode(field.label) == name:
                 return field
 
+    def normalize_record(self, instance):
+        """Update normalized fields of a model instance, before saving it.
+        Signal handlers do that for you, but bulk_create skips them."""
+        for field in self.fields:
+            if isinstance(field, StringQueryObject):
+                field.normalize_record(instance)
+
     def add_field(self, field):
         """Add a field to multiseek registry.
 
@@ -557,10 +922,19 @@ class MultiseekRegistry:
         self.fields.append(field)
         self.field_by_name = dict([(f.label, f) for f in self.fields])
 
+        if field.type == AUTOCOMPLETE and field.model is not None:
+            self.autocomplete_by_model.setdefault(field.model.__name__, field)
+
         # Check if every label is unique
         assert (len(self.field_by_name.keys()) == len(self.fields)), \
             "All fields must have unique names"
 
+    def get_autocomplete_field(self, model_name):
+        """Return the autocomplete field for a model named model_name,
+        or None if there is no such field.
+        """
+        return self.autocomplete_by_model.get(model_name)
+
     def field_by_type(self, type, public=True):
         """Return a list of fields by type.
         """
@@ -598,22 +972,147 @@ class MultiseekRegistry:
             raise UnknownOperation("%r" % field)
 
         if f.impacts_query(field['value'], field['operator']):
-            return f.query_for(field['value'], field['operator'])
+            query = f.query_for(field['value'], field['operator'])
+
+            if query is not None and \
+                    self.get_join_strategy(f.field_name) == SEMI_JOIN:
+                return self.semi_join(query)
+            return query
+
+    def get_join_strategy(self, field_name):
+        """Returns how a field is joined in the query: SEMI_JOIN for
+        multi-valued relations (see semi_join), JOIN for other relations,
+        None for fields of the registry model."""
+        if self.is_multi_valued(field_name):
+            return SEMI_JOIN
+        if '__' in field_name:
+            return JOIN
+
+    def get_join_strategies(self, data):
+        """Returns a list of join strategies (see get_join_strategy) used
+        by fields of the form data, so they can be reported."""
+        ret = []
+        for elem in data[1:]:
+            if type(elem) == list:
+                ret.extend(self.get_join_strategies(elem))
+                continue
+
+            f = self.get_field_by_name(elem.get('field'))
+            if f is None or not f.field_name:
+                continue
+
+            strategy = self.get_join_strategy(f.field_name)
+            if strategy is not None:
+                ret.append(strategy)
+        return ret
+
+    def is_multi_valued(self, field_name):
+        """Returns True if field_name traverses a multi-valued relation
+        (many-to-many or reverse foreign key) of the registry model, so
+        a record can match it many times."""
+        if field_name not in self.multi_valued:
+            self.multi_valued[field_name] = is_multi_valued(
+                self.model, field_name)
+        return self.multi_valued[field_name]
+
+    def check_ordering(self, order_by):
+        """Log a warning, once per field, if the database can't use an index
+        to sort the results by the first of order_by fields, so it will
+        sort all matching records to return the first page of them."""
+        if not order_by:
+            return
+
+        field_name = order_by[0].lstrip('-')
+        if field_name == RELEVANCE or field_name in self.indexed:
+            # Sorting by RELEVANCE is limited with relevance_row_limit
+            return
+
+        self.indexed[field_name] = is_indexed(self.model, field_name)
+        if not self.indexed[field_name]:
+            logger.warning(
+                "Sorting search results by %s can't use an index",
+                field_name)
+
+    def semi_join(self, query):
+        """Rewrite a query on a multi-valued relation (many-to-many or
+        reverse foreign key) into a pk__in subquery, so every clause gets
+        its own join (Q(authors=a) & Q(authors=b) would require one author
+        to be both a and b) and the results need no DISTINCT."""
+        negated = query.negated
+        if negated:
+            positive = Q()
+            positive.children = list(query.children)
+            positive.connector = query.connector
+            query = positive
+
+        query = Q(pk__in=self.model._default_manager.filter(
+            query).values('pk'))
+
+        if negated:
+            return ~query
+        return query
+
+    def get_date_bounds(self, field):
+        """Return a (DateQueryObject, start, end) tuple for a date field
+        (from JSON), if records matching it are in a range of dates, or
+        None. See DateQueryObject.get_bounds.
+
+        Fields on a multi-valued relation are not merged, as every clause
+        may match a different related record (see semi_join).
+        """
+        f = self.get_field_by_name(field['field'])
+        if not isinstance(f, DateQueryObject):
+            return
+
+        if self.get_join_strategy(f.field_name) == SEMI_JOIN:
+            return
+
+        bounds = f.get_bounds(f.value_from_web(field['value']),
+                              field['operator'])
+        if bounds is not None:
+            return (f, ) + bounds
 
     def get_query_recursive(self, data):
         """Recursivley get query, basing on a list of elements.
+
+        Consecutive date fields on the same field, joined with AND, are
+        merged into one range (see get_date_bounds).
         """
 
         ret = None
 
+        # (query before the merged fields, DateQueryObject, start, end)
+        merged = None
+
         for elem in data[1:]:
             if type(elem) == list:
                 qobj = self.get_query_recursive(elem)
                 prev_op = elem[0]
+                merged = None
             else:
                 qobj = self.parse_field(elem)
                 prev_op = elem.get('prev_op', None)
 
+                bounds = None
+                if qobj is not None and (ret is None or prev_op == AND):
+                    bounds = self.get_date_bounds(elem)
+
+                if bounds is None:
+                    merged = None
+                else:
+                    f, start, end = bounds
+                    before = ret
+                    if merged is not None and merged[1] is f:
+                        before = merged[0]
+                        start = combine_bounds(merged[2], start, max)
+                        end = combine_bounds(merged[3], end, min)
+
+                    merged = before, f, start, end
+                    ret = f.bounds_query(start, end)
+                    if before is not None:
+                        ret = before & ret
+                    continue
+
             if ret is None:
                 ret = qobj
                 continue
@@ -635,6 +1134,103 @@ class MultiseekRegistry:
         """
         return self.get_query_recursive(data)
 
+    def get_cached_query(self, data, query_hash):
+        """Return a query for a given JSON, reusing the query built
+        previously for the same query_hash (see get_query_hash). Use this
+        when the same query has to be applied over and over again.
+        """
+        try:
+            return self.query_cache[query_hash]
+        except KeyError:
+            pass
+
+        if len(self.query_cache) >= QUERY_CACHE_SIZE:
+            self.query_cache.clear()
+
+        query = self.get_query(data)
+        self.query_cache[query_hash] = query
+        return query
+
+    def normalize_form_recursive(self, element):
+        if type(element) != list or not element:
+            raise ParseError("Frame expected, got %r" % element)
+
+        prev_op = element[0]
+        if prev_op not in [AND, OR, ANDNOT]:
+            prev_op = None
+        result = [prev_op]
+
+        for elem in element[1:]:
+            if type(elem) == list:
+                result.append(self.normalize_form_recursive(elem))
+                continue
+
+            if type(elem) != dict:
+                raise ParseError("Field expected, got %r" % elem)
+
+            for key in ['field', 'operator', 'value']:
+                if key not in elem:
+                    raise ParseError(
+                        "Key %s not found in field %r" % (key, elem))
+
+            f = self.get_field_by_name(elem['field'])
+            if f is None:
+                raise UnknownField("Field type %r not found!" % elem)
+
+            if elem['operator'] not in f.ops:
+                raise UnknownOperation(
+                    "Operation %r not valid for field %r" % (
+                        elem['operator'], elem['field']))
+
+            if elem.get('prev_op', None) not in [AND, OR, ANDNOT, None]:
+                raise ParseError("prev_op = %r" % elem.get("prev_op", None))
+
+            value = elem['value']
+            if elem['operator'] in IN_LIST_OPS:
+                value = u", ".join(
+                    unicode(x) for x in parse_in_list(value))
+
+            result.append({
+                u'field': unicode(elem['field']),
+                u'operator': unicode(elem['operator']),
+                u'value': value,
+                u'prev_op': elem.get('prev_op', None)})
+
+        return result
+
+    def normalize_form(self, data):
+        """Validate form data (as sent by the web UI and decoded from JSON)
+        and return it in a canonical form: only known keys are kept and
+        every field is checked against the registry.
+
+        :raises: ParseError, UnknownField, UnknownOperation
+        :rtype: dict
+        """
+        if type(data) != dict:
+            raise ParseError("Form data must be a dict, got %r" % data)
+
+        ret = {}
+
+        if data.has_key('form_data'):
+            ret['form_data'] = self.normalize_form_recursive(
+                data['form_data'])
+
+        ordering = data.get('ordering')
+        if ordering:
+            if type(ordering) != dict:
+                raise ParseError("ordering = %r" % ordering)
+
+            ret['ordering'] = {}
+            for no, elem in enumerate(self.order_boxes):
+                for key in get_ordering_key_name(no):
+                    if ordering.has_key(key):
+                        ret['ordering'][key] = unicode(ordering[key])
+
+        if data.get('report_type') is not None:
+            ret['report_type'] = unicode(data['report_type'])
+
+        return ret
+
     def get_report_types(self, only_public=False):
         if only_public:
             return [x for x in self.report_types if x.public]
@@ -661,23 +1257,23 @@ class MultiseekRegistry:
         except IndexError:
             return default_retval
 
-    def get_query_for_model(self, data, removed_manually=None):
-        if data is None:
-            return self.model.objects.all()
-
-        # Fix for pre-0.8 versions
-        if type(data) != dict:
-            data = {'form_data': data}
+    def get_query_cost_action(self, queryset):
+        """Return None if the queryset can be run as it is, or one of
+        COST_* constants if its estimated cost is too high.
+        """
+        if self.max_query_cost is None:
+            return
 
-        if data.has_key("form_data"):
-            query = self.get_query(data['form_data'])
-            retval = self.model.objects.filter(query)
-        else:
-            retval = self.model.objects.all()
+        cost = explain_cost(queryset)
+        if cost is None or cost <= self.max_query_cost:
+            return
 
-        if removed_manually:
-            retval = retval.exclude(pk__in=removed_manually)
+        return self.query_cost_action
 
+    def get_ordering(self, data):
+        """Return a list of field names to pass to QuerySet.order_by,
+        basing on "ordering" element of the form data.
+        """
         sb = []
 
         ordering  = data.get("ordering")
@@ -698,66 +1294,186 @@ class MultiseekRegistry:
                     if not srt:
                         continue
 
+                    if srt == RELEVANCE:
+                        # Always the best matches first
+                        sb.append("-" + srt)
+                        continue
+
                     if ordering.has_key(key_dir) and ordering[key_dir] == "1":
                         srt = "-" + srt
 
                     sb.append(srt)
 
-            if sb:
-                retval = retval.order_by(*sb)
+        return sb
+
+    def get_query_for_model(self, data, removed_manually=None,
+                            base_queryset=None):
+        """Return a QuerySet for given form data.
+
+        :param base_queryset: if given, it will be used instead of querying
+        the model with the form data, for example to serve stored results
+        of a materialized search.
+        """
+        if data is None:
+            return self.model.objects.all()
+
+        # Fix for pre-0.8 versions
+        if type(data) != dict:
+            data = {'form_data': data}
+
+        if base_queryset is not None:
+            retval = base_queryset
+        elif data.has_key("form_data"):
+            query = self.get_query(data['form_data'])
+            if query is None:
+                # No field impacts the query
+                retval = self.model.objects.all()
+            else:
+                retval = self.model.objects.filter(query)
+        else:
+            retval = self.model.objects.all()
+
+        if removed_manually:
+            retval = retval.exclude(pk__in=removed_manually)
+
+        sb = self.get_ordering(data)
+        if "-" + RELEVANCE in sb:
+            relevance = self.get_relevance(
+                data.get('form_data'), connections[retval.db])
+            if relevance is None:
+                # Nothing to rank by
+                sb.remove("-" + RELEVANCE)
+            else:
+                retval = retval.extra(select={RELEVANCE: relevance[0]},
+                                      select_params=relevance[1])
+
+        if sb:
+            self.check_ordering(sb)
+            retval = retval.order_by(*sb)
 
         return retval
 
-    def recreate_form_recursive(self, element, info):
-        result = []
-        info.frame += 1
+    def limit_relevance(self, queryset):
+        """Return the queryset (from get_query_for_model) limited to
+        relevance_row_limit records, if it is sorted by RELEVANCE, so the
+        database needs to keep only the best matches while sorting.
+        Call it after all filtering and ordering is done, as a sliced
+        queryset can't be changed anymore."""
+        if RELEVANCE in queryset.query.extra:
+            return queryset[:self.relevance_row_limit]
+        return queryset
+
+    def get_facet_fields(self, public=True):
+        """Returns a list of fields with facet counts."""
+        return [f for f in self.get_fields(public)
+                if getattr(f, 'facet', False)]
+
+    def get_facets(self, queryset, fields):
+        """Return numbers of records of the queryset for every value of
+        every field (see get_facet_fields), with one aggregate query per
+        field.
+
+        :returns: list of (field label, [(value label, count), ...]), values
+        with most records first
+        """
+        ret = []
+        for field in fields:
+            counts = queryset.order_by().values_list(field.field_name) \
+                .annotate(multiseek_count=Count('pk', distinct=True))
+            ret.append((
+                unicode(field.label),
+                sorted([(field.facet_label(value), count)
+                        for value, count in counts],
+                       key=lambda x: -x[1])))
+        return ret
+
+    def get_text_clauses(self, element):
+        """Yield (field, value) for every clause of the form searching for
+        a string, not excluded from the results."""
+        for elem in element[1:]:
+            if type(elem) == list:
+                if elem[0] != ANDNOT:
+                    for clause in self.get_text_clauses(elem):
+                        yield clause
+                continue
+
+            if elem.get('prev_op') == ANDNOT or not elem.get('value'):
+                continue
+
+            field = self.get_field_by_name(elem['field'])
+            if isinstance(field, StringQueryObject) and \
+                    elem['operator'] in [EQUAL, CONTAINS, STARTS_WITH]:
+                yield field, elem['value']
 
-        current_frame = info.frame
+    def get_relevance(self, form_data, connection):
+        """Return SQL (and its parameters) of an expression ranking records
+        by how well they match string clauses of the form (see
+        multiseek.db.relevance_sql), or None, if there are no such clauses.
+        """
+        if not form_data:
+            return None
+
+        sql, params = [], []
+        for field, value in self.get_text_clauses(form_data):
+            field_name = field.get_matched_field_name()
+            if "__" in field_name:
+                # Fields of related models are not in the main table
+                continue
+
+            if field.normalized_field_name is not None:
+                value = normalize_string(value)
+
+            column = self.model._meta.get_field(field_name).column
+            expr, expr_params = relevance_sql(
+                self.model, column, value, field.match, connection)
+            sql.append(expr)
+            params.extend(expr_params)
+
+        if not sql:
+            return None
+        return u" + ".join(u"(%s)" % x for x in sql), params
+
+    def recreate_form_recursive(self, element):
+        result = [element[0]]
 
         for elem in element[1:]:
             if type(elem) == list:
-                result.append(
-                    "$('#frame-%s').multiseekFrame('addFrame', '%s')" % (
-                        current_frame, elem[0]))
-                result.extend(self.recreate_form_recursive(elem, info))
+                result.append(self.recreate_form_recursive(elem))
+                continue
 
-            else:
-                if elem.get("prev_op", None) not in [AND, OR, ANDNOT, None]:
-                    raise ParseError("prev_op = %r" % elem.get("prev_op", None))
+            if elem.get("prev_op", None) not in [AND, OR, ANDNOT, None]:
+                raise ParseError("prev_op = %r" % elem.get("prev_op", None))
 
-                prev_op = elem.get('prev_op', None)
-                if prev_op == None or prev_op == 'None':
-                    prev_op = 'null';
-                else:
-                    prev_op = "'" + prev_op + "'"
-                s = "$('#frame-%i').multiseekFrame('addField', '%s', '%s', '%s', %s)"
+            value = elem['value']
+            if elem['operator'] not in IN_LIST_OPS:
                 value = self.get_field_by_name(elem['field']).value_to_web(
-                    elem['value'])
+                    value)
 
-                result.append(s % (
-                    current_frame, elem['field'], elem['operator'], value,
-                    prev_op))
-                info.field += 1
+            result.append(dict(
+                field=elem['field'],
+                operator=elem['operator'],
+                value=value,
+                prev_op=elem.get('prev_op', None)))
 
         return result
 
     def recreate_form(self, data):
-        """Recreate a JavaScript code to create a given form, basing
-        on a list.
+        """Recreate a form state, which multiseek.restore in multiseek.js
+        uses to rebuild the form, basing on form data.
 
-        :returns: Javascript code to embed on the multiseek form page, which
-        will recreate form
-        :rtype: safestr
+        :returns: JSON document to embed in a <script> on the multiseek form
+        page, with form_data (values as returned by value_to_web of the
+        fields), ordering and report_type keys
+        :rtype: unicode
         """
 
-        info = _FrameInfo()
-        result = []
         if type(data) != dict:
             raise ParseError
 
+        form = {}
         if data.has_key('form_data'):
-            result = self.recreate_form_recursive(data['form_data'], info)
-        foundation = []
+            form['form_data'] = self.recreate_form_recursive(
+                data['form_data'])
 
         ordering = data.get("ordering")
         if ordering is None:
@@ -765,46 +1481,18 @@ class MultiseekRegistry:
                 ordering = self.default_ordering
 
         if ordering:
+            form['ordering'] = {}
             for no, elem in enumerate(self.order_boxes):
-                key = "%s%s" % (MULTISEEK_ORDERING_PREFIX, no)
-                if ordering.has_key(key):
-                    result.append(
-                        '\t\t'
-                        '$("select[name=%s] option").eq(%s).prop("selected", true)' % (
-                            key, ordering[key]))
-                    # foundation.append(
-                    #     '\t\t\t'
-                    #     'Foundation.libs.forms.refresh_custom_select($("select[name=%s]"), true)' % key
-                    # )
-                key = key + "_dir"
-                if ordering.has_key(key):
-                    if ordering[key] == "1":
-                        result.append(
-                            '\t\t'
-                            '$("input[name=%s]").attr("checked", true)' % key)
-                        foundation.append(
-                            '\t\t\t'
-                            '$("input[name=%s]").next().toggleClass("checked", true)' % key
-                        )
-
-        if data.has_key('report_type'):
-            if data['report_type']:
-                result.append(
-                    '\t\t'
-                    '$("select[name=%s] option").eq(%s).prop("selected", true)'
-                    % (
-                        MULTISEEK_REPORT_TYPE, data['report_type']))
-                # foundation.append(
-                #     '\t\t\t'
-                #     'Foundation.libs.forms.refresh_custom_select($("select[name=%s]"), true)' % MULTISEEK_REPORT_TYPE
-                # )
-
-        ret = u";\n".join(result) + u";\n"
-        if foundation:
-            ret += u"\t\tif (window.Foundation) {\n" + u";\n".join(
-                foundation) + u"\n\t\t}\n"
-        return ret
+                for key in get_ordering_key_name(no):
+                    if ordering.has_key(key):
+                        form['ordering'][key] = ordering[key]
+
+        if data.get('report_type'):
+            form['report_type'] = data['report_type']
 
+        # The document is embedded in HTML, so it must not close the tag
+        return json.dumps(form).replace(
+            '<', '\\u003c').replace('>', '\\u003e').replace('&', '\\u0026')
 
 
 def create_registry(model, *args, **kw):
@@ -813,7 +1501,11 @@ def create_registry(model, *args, **kw):
     for field in args:
         r.add_field(field)
 
-    known_kwargs =['ordering', 'report_types']
+    known_kwargs =['ordering', 'report_types', 'slow_search_threshold',
+                   'max_query_cost', 'query_cost_action',
+                   'query_cost_row_limit', 'statement_timeout',
+                   'relevance_row_limit', 'page_size', 'facet_rollup',
+                   'cache_rows', 'etag']
     for arg in known_kwargs:
         if arg in kw:
             setattr(r, arg, kw.pop(arg))
@@ -0,0 +1,17 @@
+# -*- encoding: utf-8 -*-
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from multiseek.logic import get_registry
+from multiseek.models import FacetCount
+
+
+class Command(BaseCommand):
+    help = 'Count records of the registry model for every value of its ' \
+           'facet fields again, for example after enabling facet_rollup ' \
+           'or changing records of related models.'
+
+    def handle(self, *args, **options):
+        registry = get_registry(settings.MULTISEEK_REGISTRY)
+        count = FacetCount.objects.rebuild(registry)
+        self.stdout.write(u"%i count(s) stored" % count)
@@ -0,0 +1,44 @@
+# -*- encoding: utf-8 -*-
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from multiseek.db import get_match_index_sql
+from multiseek.logic import get_registry, StringQueryObject
+
+
+class Command(BaseCommand):
+    help = 'Create indexes for string fields of the registry, which match ' \
+           'strings using trigram or full-text indexes.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--drop', action='store_true', default=False,
+                    help='Drop the indexes instead'),
+        make_option('--sql', action='store_true', default=False,
+                    help='Only print the SQL statements'),
+    )
+
+    def handle(self, *args, **options):
+        registry = get_registry(settings.MULTISEEK_REGISTRY)
+        connection = connections[registry.model.objects.db]
+        cursor = connection.cursor()
+
+        for field in registry.fields:
+            if not isinstance(field, StringQueryObject):
+                continue
+
+            # The normalized field, if any, is matched instead
+            field_name = field.get_matched_field_name()
+            if '__' in field_name:
+                continue
+
+            statements = get_match_index_sql(
+                registry.model, field_name, field.match,
+                connection)[options['drop']]
+
+            for sql in statements:
+                self.stdout.write(sql)
+                if not options['sql']:
+                    cursor.execute(sql)
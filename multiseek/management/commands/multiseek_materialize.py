@@ -0,0 +1,24 @@
+# -*- encoding: utf-8 -*-
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from multiseek.logic import get_registry
+from multiseek.models import SearchForm
+
+
+class Command(BaseCommand):
+    args = '[form name ...]'
+    help = 'Refresh stored results of materialized saved searches. ' \
+           'Without arguments, every materialized search is refreshed.'
+
+    def handle(self, *args, **options):
+        registry = get_registry(settings.MULTISEEK_REGISTRY)
+
+        forms = SearchForm.objects.filter(materialized=True)
+        if args:
+            forms = forms.filter(name__in=args)
+
+        for sf in forms:
+            sf.materialize(registry)
+            self.stdout.write(
+                u"%s: %i record(s)" % (sf.name, sf.materialized_results.count()))
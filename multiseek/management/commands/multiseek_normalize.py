@@ -0,0 +1,44 @@
+# -*- encoding: utf-8 -*-
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from multiseek.logic import get_registry, StringQueryObject, \
+    AutocompleteQueryObject
+
+
+class Command(BaseCommand):
+    help = 'Update normalized fields of every record of the registry ' \
+           'model and of autocompleted models, for example after adding ' \
+           'a normalized field.'
+
+    def handle(self, *args, **options):
+        registry = get_registry(settings.MULTISEEK_REGISTRY)
+
+        names = [field.normalized_field_name for field in registry.fields
+                 if isinstance(field, StringQueryObject) and
+                 field.normalized_field_name]
+        self.normalize(registry.model, names, registry.normalize_record)
+
+        for field in registry.fields:
+            if isinstance(field, AutocompleteQueryObject) and \
+                    field.normalized_search_fields:
+                self.normalize(field.model, field.normalized_search_fields,
+                               field.normalize_record)
+
+    def normalize(self, model, names, normalize_record):
+        if not names:
+            return
+
+        count = 0
+        for instance in model.objects.iterator():
+            old = [getattr(instance, name) for name in names]
+            normalize_record(instance)
+            new = [getattr(instance, name) for name in names]
+            if old != new:
+                # Don't save, to skip signal handlers of the model
+                model.objects.filter(pk=instance.pk).update(
+                    **dict(zip(names, new)))
+                count += 1
+
+        self.stdout.write(u"%s: %i record(s) updated" % (
+            model._meta.verbose_name, count))
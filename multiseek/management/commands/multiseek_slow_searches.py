@@ -0,0 +1,34 @@
+# -*- encoding: utf-8 -*-
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db.models import Count, Max
+
+from multiseek.models import SlowSearch
+
+
+class Command(BaseCommand):
+    help = 'List the slowest logged searches, grouped by query.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--limit', type='int', default=10,
+                    help='Number of queries to list'),
+    )
+
+    def handle(self, *args, **options):
+        top = SlowSearch.objects.values('query_hash').annotate(
+            max_duration=Max('duration'),
+            count=Count('pk')
+        ).order_by('-max_duration')[:options['limit']]
+
+        for elem in top:
+            slowest = SlowSearch.objects.filter(
+                query_hash=elem['query_hash']).order_by('-duration')[0]
+
+            self.stdout.write(
+                u"%.3f s (logged %i time(s)), %i record(s) on the page, "
+                u"ordering %s, report type %r" % (
+                    elem['max_duration'], elem['count'], slowest.page_row_count,
+                    slowest.ordering, slowest.report_type))
+            self.stdout.write(u"  form: %s" % slowest.form_data)
+            self.stdout.write(u"  SQL: %s" % slowest.sql)
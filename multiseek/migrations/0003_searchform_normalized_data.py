@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('multiseek', '0002_searchform_index_together'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='searchform',
+            name='normalized_data',
+            field=models.TextField(verbose_name='Normalized form data (JSON)', blank=True),
+        ),
+        migrations.AddField(
+            model_name='searchform',
+            name='query_hash',
+            field=models.CharField(db_index=True, max_length=40, verbose_name='Query hash', blank=True),
+        ),
+        migrations.AddField(
+            model_name='searchform',
+            name='schema_version',
+            field=models.PositiveSmallIntegerField(default=0, verbose_name='Schema version'),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('multiseek', '0003_searchform_normalized_data'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='searchform',
+            name='materialized',
+            field=models.BooleanField(default=False, help_text='Store the results of this search and serve them until they get refreshed?', verbose_name='Materialized'),
+        ),
+        migrations.AddField(
+            model_name='searchform',
+            name='materialized_on',
+            field=models.DateTimeField(null=True, verbose_name='Results refreshed on', blank=True),
+        ),
+        migrations.CreateModel(
+            name='MaterializedResult',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('object_pk', models.IntegerField()),
+                ('search_form', models.ForeignKey(related_name='materialized_results', to='multiseek.SearchForm')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='materializedresult',
+            unique_together=set([('search_form', 'object_pk')]),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('multiseek', '0004_materialized_results'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SlowSearch',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('created_on', models.DateTimeField(auto_now_add=True, verbose_name='Created on')),
+                ('duration', models.FloatField(verbose_name='Duration (seconds)')),
+                ('page_row_count', models.IntegerField(verbose_name='Number of records on the page')),
+                ('query_hash', models.CharField(max_length=40, verbose_name='Query hash', db_index=True)),
+                ('form_data', models.TextField(verbose_name='Form data (JSON)')),
+                ('sql', models.TextField(verbose_name='SQL')),
+                ('ordering', models.TextField(verbose_name='Ordering')),
+                ('report_type', models.TextField(verbose_name='Report type', blank=True)),
+            ],
+            options={
+                'ordering': ['-created_on'],
+            },
+        ),
+    ]
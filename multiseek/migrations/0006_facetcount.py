@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('multiseek', '0005_slowsearch'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FacetCount',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('model', models.CharField(max_length=255, verbose_name='Model')),
+                ('field', models.CharField(max_length=255, verbose_name='Field')),
+                ('value', models.TextField(verbose_name='Value (JSON)')),
+                ('count', models.IntegerField(verbose_name='Number of records')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='facetcount',
+            unique_together=set([('model', 'field', 'value')]),
+        ),
+    ]
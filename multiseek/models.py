@@ -1,8 +1,98 @@
-from django.db import models
-from django.db.models import Q
-from django.utils.translation import ugettext_lazy as _
+import json
+import logging
+from uuid import uuid4
+
+from django.core.cache import cache
+from django.db import models, transaction, IntegrityError
+from django.db.models import Q, F
+from django.db.models.signals import pre_save, post_save, pre_delete, \
+    post_delete, m2m_changed
+from django.dispatch import receiver
+from django.utils.timezone import now
+from django.utils.translation import ugettext_lazy as _, get_language
 from django.conf import settings
 
+from multiseek.logic import FORM_SCHEMA_VERSION, get_query_hash, \
+    UnknownField, UnknownOperation, ParseError
+
+logger = logging.getLogger(__name__)
+
+SAVED_FORMS_CACHE_KEY = 'multiseek_saved_forms_%s_%s'
+SAVED_FORMS_VERSION_KEY = 'multiseek_saved_forms_version'
+SAVED_FORMS_CACHE_TIMEOUT = getattr(
+    settings, 'MULTISEEK_SAVED_FORMS_CACHE_TIMEOUT', 300)
+SLOW_SEARCH_LOG_SIZE = getattr(
+    settings, 'MULTISEEK_SLOW_SEARCH_LOG_SIZE', 1000)
+
+ROW_CACHE_KEY = 'multiseek_row_%s_%s_%s_%s_%s'
+ROW_CACHE_VERSION_KEY = 'multiseek_row_version'
+ROW_CACHE_TIMEOUT = getattr(settings, 'MULTISEEK_ROW_CACHE_TIMEOUT', 3600)
+
+DATA_VERSION_KEY = 'multiseek_data_version_%s'
+
+
+def invalidate_saved_forms_cache():
+    """Make every cached list of saved forms stale. Lists are cached per
+    user, so instead of deleting them one-by-one, we change the version
+    part of their cache keys."""
+    cache.set(SAVED_FORMS_VERSION_KEY, uuid4().hex, None)
+
+
+def invalidate_row_cache():
+    """Make every cached row of results stale, for example after changing
+    a related model or a template of rows."""
+    cache.set(ROW_CACHE_VERSION_KEY, uuid4().hex, None)
+
+
+def invalidate_data_version(model):
+    """Change the version of records of the model, which is a part of
+    ETags of search results (see MultiseekResults.get_etag)."""
+    cache.set(DATA_VERSION_KEY % get_model_key(model), uuid4().hex, None)
+
+
+def get_data_version(model):
+    """Return a version of records of the model, changed every time
+    a record is saved or deleted by the handlers connected with
+    connect_registry_signals, or None if the cache does not keep it (like
+    DummyCache)."""
+    key = DATA_VERSION_KEY % get_model_key(model)
+    version = cache.get(key)
+    if version is None:
+        invalidate_data_version(model)
+        version = cache.get(key)
+    return version
+
+
+def get_row_cache_keys(model, report_type, pks, language=None):
+    """Return cache keys of rendered rows of results (see
+    MultiseekResults.render_rows) of records of the model, in the language
+    (by default, the active one), as templates of rows can be translated."""
+    version = cache.get(ROW_CACHE_VERSION_KEY)
+    if version is None:
+        invalidate_row_cache()
+        version = cache.get(ROW_CACHE_VERSION_KEY)
+
+    if language is None:
+        language = get_language()
+
+    model_key = get_model_key(model)
+    return [ROW_CACHE_KEY % (version, model_key, report_type, language, pk)
+            for pk in pks]
+
+
+def delete_cached_rows(registry, pk):
+    """Remove rendered rows of a record of registry model, in every report
+    type and language of the site, from the cache."""
+    report_types = set([''] + [x.id for x in registry.report_types])
+    languages = set([settings.LANGUAGE_CODE] +
+                    [code for code, name in settings.LANGUAGES])
+    keys = []
+    for report_type in report_types:
+        for language in languages:
+            keys.extend(get_row_cache_keys(
+                registry.model, report_type, [pk], language))
+    cache.delete_many(keys)
+
 
 class SearchFormManager(models.Manager):
     def get_for_user(self, user):
@@ -12,6 +102,27 @@ class SearchFormManager(models.Manager):
         return self.filter(
             Q(public=True) | Q(owner=user))
 
+    def get_names_for_user(self, user):
+        """Return a list of (pk, name) tuples of forms available for the
+        user, without loading the form data. The list is cached per user
+        and invalidated every time a form is saved or deleted.
+        """
+        version = cache.get(SAVED_FORMS_VERSION_KEY)
+        if version is None:
+            invalidate_saved_forms_cache()
+            version = cache.get(SAVED_FORMS_VERSION_KEY)
+
+        user_key = 'anonymous'
+        if not user.is_anonymous():
+            user_key = user.pk
+
+        key = SAVED_FORMS_CACHE_KEY % (version, user_key)
+        ret = cache.get(key)
+        if ret is None:
+            ret = list(self.get_for_user(user).values_list('pk', 'name'))
+            cache.set(key, ret, SAVED_FORMS_CACHE_TIMEOUT)
+        return ret
+
 
 class SearchForm(models.Model):
     name = models.TextField(verbose_name=_("Name"), unique=True)
@@ -21,11 +132,373 @@ class SearchForm(models.Model):
         default=False, help_text=_(
             "Make this search publicly available?"))
     data = models.TextField(verbose_name=_("Form data (JSON)"))
+    normalized_data = models.TextField(
+        verbose_name=_("Normalized form data (JSON)"), blank=True)
+    query_hash = models.CharField(
+        verbose_name=_("Query hash"), max_length=40, blank=True,
+        db_index=True)
+    schema_version = models.PositiveSmallIntegerField(
+        verbose_name=_("Schema version"), default=0)
+
+    materialized = models.BooleanField(
+        verbose_name=_("Materialized"), default=False, help_text=_(
+            "Store the results of this search and serve them until "
+            "they get refreshed?"))
+    materialized_on = models.DateTimeField(
+        verbose_name=_("Results refreshed on"), null=True, blank=True)
 
     objects = SearchFormManager()
 
     class Meta:
         ordering = ['name',]
+        index_together = [
+            ('public', 'name'),
+            ('owner', 'name'),
+        ]
 
     def __unicode__(self):
-        return self.name
\ No newline at end of file
+        return self.name
+
+    def set_form_data(self, data, normalized):
+        """Set form data: the raw JSON, as sent by the user and the
+        normalized form data, as returned by MultiseekRegistry.normalize_form.
+        """
+        query_hash = get_query_hash(normalized)
+        if query_hash != self.query_hash:
+            # Stored results, if any, are not valid for the new query
+            self.materialized_on = None
+
+        self.data = data
+        self.normalized_data = json.dumps(normalized)
+        self.query_hash = query_hash
+        self.schema_version = FORM_SCHEMA_VERSION
+
+    def get_form_data(self):
+        """Return JSON with form data, preferring the validated, normalized
+        version, if it was stored using the current schema version.
+        """
+        if self.schema_version == FORM_SCHEMA_VERSION and \
+                self.normalized_data:
+            return self.normalized_data
+        return self.data
+
+    @transaction.atomic
+    def materialize(self, registry):
+        """Run this search and store primary keys of matching records,
+        replacing results stored previously.
+
+        :type registry: multiseek.logic.MultiseekRegistry
+        """
+        if self.schema_version != FORM_SCHEMA_VERSION or \
+                not self.normalized_data:
+            # Saved before normalized form data was stored
+            self.set_form_data(
+                self.data, registry.normalize_form(json.loads(self.data)))
+
+        data = json.loads(self.get_form_data())
+        pks = set(registry.get_query_for_model(data).order_by().values_list(
+            'pk', flat=True))
+
+        self.materialized_results.all().delete()
+        MaterializedResult.objects.bulk_create(
+            [MaterializedResult(search_form=self, object_pk=pk)
+             for pk in pks],
+            batch_size=500)
+
+        self.materialized_on = now()
+        self.save()
+
+    def get_materialized_queryset(self, model):
+        """Return a QuerySet of records stored by the last materialize
+        call."""
+        return model.objects.filter(
+            pk__in=self.materialized_results.values('object_pk'))
+
+
+class MaterializedResult(models.Model):
+    """A record matching a materialized SearchForm."""
+    search_form = models.ForeignKey(
+        SearchForm, related_name='materialized_results')
+    object_pk = models.IntegerField()
+
+    class Meta:
+        unique_together = [('search_form', 'object_pk')]
+
+
+@receiver(post_save, sender=SearchForm)
+@receiver(post_delete, sender=SearchForm)
+def search_form_changed(sender, **kwargs):
+    invalidate_saved_forms_cache()
+
+
+class SlowSearchManager(models.Manager):
+    def log(self, **kwargs):
+        """Log a slow search, removing the oldest entries, so the log
+        never grows beyond MULTISEEK_SLOW_SEARCH_LOG_SIZE entries.
+        """
+        ret = self.create(**kwargs)
+
+        cutoff = self.order_by('-pk').values_list('pk', flat=True)[
+            SLOW_SEARCH_LOG_SIZE:SLOW_SEARCH_LOG_SIZE + 1]
+        if cutoff:
+            self.filter(pk__lte=cutoff[0]).delete()
+
+        return ret
+
+
+class SlowSearch(models.Model):
+    """A search, which took longer than slow_search_threshold of the
+    registry to execute."""
+    created_on = models.DateTimeField(
+        verbose_name=_("Created on"), auto_now_add=True)
+    duration = models.FloatField(verbose_name=_("Duration (seconds)"))
+    # Results are not counted, see MultiseekResults.get_page
+    page_row_count = models.IntegerField(
+        verbose_name=_("Number of records on the page"))
+    query_hash = models.CharField(
+        verbose_name=_("Query hash"), max_length=40, db_index=True)
+    form_data = models.TextField(verbose_name=_("Form data (JSON)"))
+    sql = models.TextField(verbose_name=_("SQL"))
+    ordering = models.TextField(verbose_name=_("Ordering"))
+    report_type = models.TextField(
+        verbose_name=_("Report type"), blank=True)
+
+    objects = SlowSearchManager()
+
+    class Meta:
+        ordering = ['-created_on']
+
+    def __unicode__(self):
+        return u"%.3f s, %s" % (self.duration, self.query_hash)
+
+
+def get_model_key(model):
+    return u'%s.%s' % (model._meta.app_label, model._meta.model_name)
+
+
+class FacetCountManager(models.Manager):
+    def get_facets(self, registry, fields):
+        """Return numbers of all records of registry model for every value
+        of the fields, like MultiseekRegistry.get_facets, but from stored
+        counts."""
+        counts = {}
+        for fc in self.filter(model=get_model_key(registry.model),
+                              field__in=[f.field_name for f in fields],
+                              count__gt=0):
+            counts.setdefault(fc.field, []).append(
+                (json.loads(fc.value), fc.count))
+
+        return [(unicode(field.label),
+                 sorted([(field.facet_label(value), count)
+                         for value, count in counts.get(field.field_name, [])],
+                        key=lambda x: -x[1]))
+                for field in fields]
+
+    def update_counts(self, registry, old, new):
+        """Update stored counts after a record changed values of facet
+        fields from old to new (see get_facet_values)."""
+        key = get_model_key(registry.model)
+        for field_name in set(old.keys()) | set(new.keys()):
+            before = old.get(field_name, set())
+            after = new.get(field_name, set())
+
+            for values, delta in [(before - after, -1), (after - before, 1)]:
+                for value in values:
+                    value = json.dumps(value)
+                    counts = self.filter(
+                        model=key, field=field_name, value=value)
+                    updated = counts.update(count=F('count') + delta)
+                    if updated or delta < 0:
+                        continue
+
+                    try:
+                        with transaction.atomic():
+                            self.create(model=key, field=field_name,
+                                        value=value, count=delta)
+                    except IntegrityError:
+                        # Created by a concurrent save in the meantime
+                        counts.update(count=F('count') + delta)
+
+    @transaction.atomic
+    def rebuild(self, registry):
+        """Count records of registry model for every value of its facet
+        fields again, replacing stored counts."""
+        key = get_model_key(registry.model)
+        self.filter(model=key).delete()
+
+        counts = []
+        for field in registry.get_facet_fields(public=False):
+            for value, count in registry.model.objects.order_by() \
+                    .values_list(field.field_name) \
+                    .annotate(multiseek_count=models.Count('pk',
+                                                           distinct=True)):
+                counts.append(FacetCount(
+                    model=key, field=field.field_name,
+                    value=json.dumps(value), count=count))
+        self.bulk_create(counts, batch_size=500)
+        return len(counts)
+
+
+class FacetCount(models.Model):
+    """Number of records of a model with a value of a facet field, kept up
+    to date on every change of the records, if facet_rollup of the
+    registry is enabled."""
+    model = models.CharField(verbose_name=_("Model"), max_length=255)
+    field = models.CharField(verbose_name=_("Field"), max_length=255)
+    value = models.TextField(verbose_name=_("Value (JSON)"))
+    count = models.IntegerField(verbose_name=_("Number of records"))
+
+    objects = FacetCountManager()
+
+    class Meta:
+        unique_together = [('model', 'field', 'value')]
+
+    def __unicode__(self):
+        return u"%s.%s = %s: %i" % (
+            self.model, self.field, self.value, self.count)
+
+
+def get_facet_values(registry, pk):
+    """Return a dict of sets of values of facet fields of a record of
+    registry model, with one query."""
+    names = [f.field_name for f in registry.get_facet_fields(public=False)]
+    if not names:
+        return {}
+
+    ret = dict((name, set()) for name in names)
+    for row in registry.model.objects.filter(pk=pk).values_list(*names):
+        for name, value in zip(names, row):
+            ret[name].add(value)
+    return ret
+
+
+def update_materialized_results(registry, pk, deleted=False):
+    """Add or remove a single record of registry model to or from stored
+    results of every materialized search, depending on whether it still
+    matches the query. Only that record is checked, so the cost of keeping
+    stored results fresh depends on the number of changes, not on the size
+    of the table.
+    """
+    forms = SearchForm.objects.filter(
+        materialized=True, materialized_on__isnull=False)
+
+    if deleted:
+        MaterializedResult.objects.filter(
+            search_form__in=forms, object_pk=pk).delete()
+        return
+
+    for sf in forms:
+        data = json.loads(sf.get_form_data())
+        matches = registry.model.objects.filter(pk=pk)
+        if data.get('form_data'):
+            try:
+                query = registry.get_cached_query(
+                    data['form_data'], get_query_hash(data))
+            except (UnknownField, UnknownOperation, ParseError):
+                # The form does not match the registry anymore; saving
+                # records must not depend on it
+                logger.exception(
+                    "Can't update stored results of search form %s", sf.pk)
+                continue
+
+            if query is not None:
+                matches = matches.filter(query)
+
+        if matches.exists():
+            MaterializedResult.objects.get_or_create(
+                search_form=sf, object_pk=pk)
+        else:
+            MaterializedResult.objects.filter(
+                search_form=sf, object_pk=pk).delete()
+
+
+def normalize_autocomplete_record(field):
+    def handler(sender, instance, **kwargs):
+        field.normalize_record(instance)
+    return handler
+
+
+def connect_registry_signals(registry):
+    """Connect signal handlers of registry model, which keep data derived
+    from it (like normalized fields or stored results of materialized
+    searches) up to date.
+
+    Call it once, in the module defining your registry.
+
+    :type registry: multiseek.logic.MultiseekRegistry
+    """
+    model = registry.model
+    uid = 'multiseek-%s-%s' % (model._meta.app_label, model._meta.model_name)
+
+    def record_saving(sender, instance, raw=False, **kwargs):
+        registry.normalize_record(instance)
+        if registry.facet_rollup and not raw and instance.pk is not None:
+            instance._multiseek_facet_values = get_facet_values(
+                registry, instance.pk)
+
+    def record_saved(sender, instance, raw=False, **kwargs):
+        if raw:
+            return
+        invalidate_data_version(registry.model)
+        update_materialized_results(registry, instance.pk)
+        if registry.cache_rows:
+            delete_cached_rows(registry, instance.pk)
+        if registry.facet_rollup:
+            FacetCount.objects.update_counts(
+                registry,
+                instance.__dict__.pop('_multiseek_facet_values', {}),
+                get_facet_values(registry, instance.pk))
+
+    def record_deleting(sender, instance, **kwargs):
+        if registry.facet_rollup:
+            instance._multiseek_facet_values = get_facet_values(
+                registry, instance.pk)
+
+    def record_deleted(sender, instance, **kwargs):
+        invalidate_data_version(registry.model)
+        update_materialized_results(registry, instance.pk, deleted=True)
+        if registry.cache_rows:
+            delete_cached_rows(registry, instance.pk)
+        if registry.facet_rollup:
+            FacetCount.objects.update_counts(
+                registry,
+                instance.__dict__.pop('_multiseek_facet_values', {}), {})
+
+    def relation_changed(sender, instance, action, reverse, pk_set, **kwargs):
+        if action not in ['post_add', 'post_remove', 'post_clear']:
+            return
+
+        invalidate_data_version(registry.model)
+
+        if not reverse:
+            update_materialized_results(registry, instance.pk)
+            if registry.cache_rows:
+                delete_cached_rows(registry, instance.pk)
+            return
+
+        # post_clear on the reverse side does not tell us, which records
+        # were affected
+        for pk in pk_set or []:
+            update_materialized_results(registry, pk)
+            if registry.cache_rows:
+                delete_cached_rows(registry, pk)
+
+    pre_save.connect(
+        record_saving, sender=model, weak=False, dispatch_uid=uid)
+    post_save.connect(
+        record_saved, sender=model, weak=False, dispatch_uid=uid)
+    pre_delete.connect(
+        record_deleting, sender=model, weak=False, dispatch_uid=uid)
+    post_delete.connect(
+        record_deleted, sender=model, weak=False, dispatch_uid=uid)
+
+    for field in registry.fields:
+        if getattr(field, 'normalized_search_fields', None):
+            pre_save.connect(
+                normalize_autocomplete_record(field), sender=field.model,
+                weak=False, dispatch_uid=uid + '-' + field.field_name)
+
+    for field in model._meta.many_to_many:
+        m2m_changed.connect(
+            relation_changed, sender=field.rel.through, weak=False,
+            dispatch_uid=uid + '-' + field.name)
@@ -0,0 +1,13 @@
+# -*- encoding: utf-8 -*-
+from django.dispatch import Signal
+
+# Sent by MultiseekResults after every phase of a search (see
+# multiseek.instrumentation.SearchTimings). duration is in seconds, queries
+# is the number of database queries made during the phase or None,
+# if the queries are not being logged by Django.
+search_phase = Signal(
+    providing_args=["phase", "duration", "queries", "request"])
+
+# Sent by MultiseekResults when something worth counting happens during
+# a search, like cancelling a query because of a statement timeout.
+search_event = Signal(providing_args=["event", "request"])
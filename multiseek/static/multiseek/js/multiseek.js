@@ -6,6 +6,12 @@ if (typeof String.prototype.startsWith != 'function') {
     };
 }
 
+if (typeof String.prototype.endsWith != 'function') {
+    String.prototype.endsWith = function (str) {
+        return this.indexOf(str, this.length - str.length) != -1;
+    };
+}
+
 if (window.multiseek == undefined) window.multiseek = {};
 
 multiseek = {
@@ -23,7 +29,10 @@ multiseek = {
         'date': 'multiseekDateValue',
         'autocomplete': 'multiseekAutocompleteValue',
         'range': 'multiseekRangeValue'
-    }
+    },
+
+    // Used instead of widgetMapping for in_list_ops
+    inListWidget: 'multiseekInListValue'
 };
 
 function installDatePicker(element) {
@@ -123,6 +132,19 @@ $.widget("multiseek.multiseekIntegerValue", $.multiseek.multiseekStringValue, {
     }
 });
 
+$.widget("multiseek.multiseekInListValue", $.multiseek.multiseekStringValue, {
+    _create: function () {
+        this.element.append(
+            $('<textarea/>')
+                .attr("name", "value")
+                .attr("id", "value")
+                .attr("rows", "3")
+                .attr("cols", "30")
+                .attr("placeholder", gettext("paste a list of numbers"))
+        );
+    }
+});
+
 $.widget("multiseek.multiseekDecimalValue", $.multiseek.multiseekStringValue, {
     getValue: function () {
         return parseFloat(this.element.children().first().val()).toFixed(3);
@@ -359,6 +381,8 @@ $.widget("multiseek.multiseekField", $.multiseek.multiseekBase, {
     },
 
     getWidgetType: function () {
+        if (in_list_ops.indexOf(this.opSelect().val()) != -1)
+            return multiseek.inListWidget;
         return multiseek.widgetMapping[this.getFieldType()];
     },
 
@@ -380,6 +404,8 @@ $.widget("multiseek.multiseekField", $.multiseek.multiseekBase, {
     },
 
     opSelectChanged: function (evt) {
+        if (this.getWidgetType() != this.valueWidgetType)
+            this.initializeValueWidget();
         this.updateValueWidget();
     },
 
@@ -422,8 +448,10 @@ $.widget("multiseek.multiseekField", $.multiseek.multiseekBase, {
         var x = p.append("<span/>");
         p = $(p.children()[0]);
 
-        switch (this.getFieldType()) {
-            case 'autocomplete':
+        this.valueWidgetType = this.getWidgetType();
+
+        switch (this.valueWidgetType) {
+            case 'multiseekAutocompleteValue':
                 p.multiseekAutocompleteValue(
                     {'url': autocompletes[this.getFieldName()]})
                 break;
@@ -643,12 +671,14 @@ $.widget("multiseek.multiseekFrame", $.multiseek.multiseekBase, {
         elem = this.getFieldDOM(id);
         this.fieldList().append(elem);
 
-        var fld = $("#" + id);
-        fld.multiseekField();
+        // Don't look the field up by id: the frame may not be in
+        // the document yet, see multiseek.restore
+        elem.multiseekField();
         if (type && operation)
-            fld.multiseekField("setValue", type, operation, value, op);
+            elem.multiseekField("setValue", type, operation, value, op);
         multiseek.field_counter++;
 
+        return elem;
     },
 
     addFieldViaButton: function () {
@@ -659,11 +689,8 @@ $.widget("multiseek.multiseekFrame", $.multiseek.multiseekBase, {
     addFrame: function (prevOpValue) {
         var id = "frame-" + multiseek.frame_counter;
         var has_elements = this.fieldList().children().length;
-        this.fieldList().append(
-            $("<div/>")
-                .attr("id", id)
-        );
-        var fr = $("#" + id);
+        var fr = $("<div/>").attr("id", id);
+        this.fieldList().append(fr);
         fr.multiseekFrame();
         if (has_elements) {
             fr.multiseekFrame("prevOperation", "enable");
@@ -697,6 +724,47 @@ $.widget("multiseek.multiseekFrame", $.multiseek.multiseekBase, {
     }
 });
 
+function restoreFrame(frame, data) {
+    data.slice(1).forEach(function (elem) {
+        if ($.isArray(elem)) {
+            restoreFrame(frame.multiseekFrame("addFrame", elem[0]), elem);
+            return;
+        }
+        frame.multiseekFrame(
+            "addField", elem.field, elem.operator, elem.value, elem.prev_op);
+    });
+}
+
+multiseek.restore = function (form) {
+    /* Restore the form from a JSON document, made by
+     MultiseekRegistry.recreate_form. Fields and frames are created while
+     the first frame is detached from the document, so it is inserted
+     back only once. */
+    if (form.form_data) {
+        var frame = $("#frame-0");
+        var marker = $("<div/>").insertBefore(frame);
+        frame.detach();
+        restoreFrame(frame, form.form_data);
+        marker.replaceWith(frame);
+    }
+
+    $.each(form.ordering || {}, function (key, value) {
+        if (key.endsWith("_dir")) {
+            if (value == "1") {
+                var input = $("input[name=" + key + "]").prop("checked", true);
+                if (window.Foundation)
+                    input.next().toggleClass("checked", true);
+            }
+            return;
+        }
+        $("select[name=" + key + "] option").eq(value).prop("selected", true);
+    });
+
+    if (form.report_type)
+        $("select[name=_ms_report_type] option")
+            .eq(form.report_type).prop("selected", true);
+};
+
 function formOrdering() {
     ret = {};
 
@@ -2,4 +2,6 @@
 
 from multiseek.tests.test_logic import *
 from multiseek.tests.test_views import *
-from multiseek.tests.test_models import *
\ No newline at end of file
+from multiseek.tests.test_models import *
+from multiseek.tests.test_db import *
+from multiseek.tests.test_jobs import *
@@ -0,0 +1,98 @@
+# -*- encoding: utf-8 -*-
+
+from django.db import connection, OperationalError
+from django.test import TestCase
+from model_mommy import mommy
+
+from multiseek.db import explain_cost, statement_timeout, QueryTimeout, \
+    get_match_index_sql, FULLTEXT, ILIKE, IN_VALUES
+from test_app.models import Book
+
+
+class TestExplainCost(TestCase):
+    def test_explain_cost(self):
+        mommy.make(Book, title='foo', _quantity=3)
+
+        self.assertEquals(explain_cost(Book.objects.none()), 0)
+
+        full_scan = explain_cost(Book.objects.filter(title__icontains='f'))
+        by_pk = explain_cost(Book.objects.filter(pk=1))
+        self.assert_(full_scan > by_pk)
+
+
+class TestStatementTimeout(TestCase):
+    def count_to(self, n):
+        cursor = connection.cursor()
+        cursor.execute(
+            "WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL "
+            "SELECT x + 1 FROM c WHERE x < %s) SELECT COUNT(*) FROM c", [n])
+        return cursor.fetchone()[0]
+
+    def test_statement_timeout(self):
+        with statement_timeout(None):
+            self.assertEquals(self.count_to(10), 10)
+
+        with statement_timeout(10):
+            self.assertEquals(self.count_to(10), 10)
+
+        def run():
+            with statement_timeout(0.01):
+                self.count_to(10 ** 9)
+
+        self.assertRaises(QueryTimeout, run)
+
+
+class TestMatchLookups(TestCase):
+    def setUp(self):
+        for title in [u'Żółw i zając', u'Zając', u'Psy']:
+            mommy.make(Book, title=title)
+
+    def titles(self, **kw):
+        return sorted(Book.objects.filter(**kw).values_list(
+            'title', flat=True))
+
+    def test_ilike(self):
+        self.assertEquals(
+            self.titles(title__multiseek_ilike='ps'), [u'Psy'])
+
+    def test_fulltext(self):
+        create, drop = get_match_index_sql(Book, 'title', FULLTEXT, connection)
+        cursor = connection.cursor()
+        try:
+            cursor.execute(create[0])
+        except OperationalError:
+            self.skipTest("SQLite was built without FTS5")
+        for sql in create[1:]:
+            cursor.execute(sql)
+
+        try:
+            mommy.make(Book, title=u'Zając i jeż')
+            self.assertEquals(
+                self.titles(title__multiseek_fulltext=u'zaj i'),
+                [u'Zając i jeż', u'Żółw i zając'])
+            # No words, works like icontains
+            self.assertEquals(
+                self.titles(title__multiseek_fulltext=u'!'), [])
+        finally:
+            for sql in drop:
+                cursor.execute(sql)
+
+    def test_match_index_sql(self):
+        self.assertEquals(
+            get_match_index_sql(Book, 'title', ILIKE, connection), ([], []))
+
+
+class TestInValues(TestCase):
+    def test_in_values(self):
+        # Years of fixture books are not used
+        books = [mommy.make(Book, year=year) for year in [1900, 1901, 1902]]
+        self.assertEquals(
+            sorted(Book.objects.filter(**{
+                'year__' + IN_VALUES: [1900, 1902, 1899]}).values_list(
+                'year', flat=True)),
+            [1900, 1902])
+        self.assertEquals(
+            Book.objects.filter(**{
+                'pk__' + IN_VALUES: [books[1].pk]}).get(), books[1])
+        self.assertEquals(
+            Book.objects.filter(**{'year__' + IN_VALUES: []}).count(), 0)
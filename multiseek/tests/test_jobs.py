@@ -0,0 +1,73 @@
+# -*- encoding: utf-8 -*-
+import json
+
+from django.test import TestCase
+from django.test.client import RequestFactory
+from mock import MagicMock, patch
+from model_mommy import mommy
+
+from multiseek import jobs
+from multiseek.jobs import run_search, set_job, get_job, get_job_page, \
+    RUNNING, DONE, FAILED, ThreadJobRunner
+from multiseek.tests.test_views import setup_anonymous_session
+from multiseek.views import job_status, MULTISEEK_SESSION_KEY_JOB
+from test_app.models import Book
+
+
+class TestRunSearch(TestCase):
+    def test_run_search(self):
+        books = mommy.make(Book, _quantity=5)
+        queryset = Book.objects.filter(
+            pk__in=[x.pk for x in books]).order_by('pk')
+
+        set_job('foo', RUNNING)
+        with patch.object(jobs, 'JOB_PAGE_SIZE', 2):
+            run_search('foo', Book, queryset.query)
+
+        self.assertEquals(get_job('foo'), dict(
+            id='foo', status=DONE, count=5, pages=3))
+
+        pks = list(queryset.values_list('pk', flat=True))
+        self.assertEquals(get_job_page('foo', 0), pks[:2])
+        self.assertEquals(get_job_page('foo', 2), pks[4:])
+        self.assertEquals(get_job_page('foo', 3), None)
+
+    def test_run_search_fails(self):
+        query = MagicMock()
+        query.clone.side_effect = Exception("boom")
+        run_search('bar', Book, query)
+        self.assertEquals(get_job('bar')['status'], FAILED)
+
+    def test_thread_job_runner(self):
+        function = MagicMock()
+        with patch('multiseek.jobs.connection') as connection:
+            ThreadJobRunner(1).run(function, 1, 2)
+        function.assert_called_once_with(1, 2)
+        self.assert_(connection.close.called)
+
+    def test_thread_job_runner_pool(self):
+        function = MagicMock()
+        runner = ThreadJobRunner(2)
+        with patch('multiseek.jobs.connection'):
+            for no in range(5):
+                runner.submit(function, no)
+            runner.queue.join()
+        self.assertEquals(len(runner.workers), 2)
+        self.assertEquals(
+            sorted(x[0] for x in function.call_args_list),
+            [(0, ), (1, ), (2, ), (3, ), (4, )])
+
+
+class TestJobStatus(TestCase):
+    def test_job_status(self):
+        request = setup_anonymous_session(RequestFactory().get('/'))
+        self.assertEquals(job_status(request, 'foo').status_code, 404)
+
+        request.session[MULTISEEK_SESSION_KEY_JOB] = ['foo', 'key']
+        self.assertEquals(job_status(request, 'foo').status_code, 404)
+
+        set_job('foo', RUNNING, 150, 1)
+        res = job_status(request, 'foo')
+        self.assertEquals(res.status_code, 200)
+        self.assertEquals(json.loads(res.content), dict(
+            id='foo', status=RUNNING, count=150, pages=1))
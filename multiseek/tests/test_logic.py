@@ -1,15 +1,23 @@
 # -*- encoding: utf-8 -*-
 
 import json
+from datetime import date
 from unittest import TestCase
 
+from django.test.utils import override_settings
+from django.utils import timezone
+
 from mock import MagicMock
 
 from multiseek.logic import UnknownOperation, AutocompleteQueryObject, \
     RangeQueryObject, RANGE_OPS, StringQueryObject, QueryObject, DIFFERENT, \
     NOT_CONTAINS, NOT_STARTS_WITH, MultiseekRegistry, STRING, ParseError, \
     UnknownField, EQUALITY_OPS_ALL, OR, AND, create_registry, get_registry, \
-    EQUAL, IntegerQueryObject, LESSER_OR_EQUAL, RANGE, ReportType, Ordering, MULTISEEK_ORDERING_PREFIX
+    EQUAL, IntegerQueryObject, LESSER_OR_EQUAL, RANGE, ReportType, Ordering, MULTISEEK_ORDERING_PREFIX, \
+    get_query_hash, CONTAINS, MATCH_FULLTEXT, STARTS_WITH, DateQueryObject, \
+    EQUAL_FEMALE, DIFFERENT_FEMALE, GREATER_FEMALE, GREATER_OR_EQUAL_FEMALE, \
+    LESSER_FEMALE, IN_RANGE, IN_LIST, NOT_IN_LIST, parse_in_list, \
+    RELEVANCE, get_ordering_key_name
 from multiseek.models import SearchForm
 from multiseek.util import make_field
 
@@ -63,6 +71,35 @@ class TestStringQueryObject(TestCase):
             UnknownOperation,
             self.q.real_query, 'lol', 'bad operation')
 
+    def test_normalized_field_name(self):
+        q = StringQueryObject('foo', normalized_field_name='foo_normalized')
+        self.assertEquals(
+            sorted(q.query_for(u"Foo", STARTS_WITH).children),
+            [('foo_normalized__gte', u'foo'), ('foo_normalized__lt', u'fop')])
+        self.assertEquals(
+            str(q.query_for(u"Żółw", DIFFERENT)),
+            "(NOT (AND: ('foo_normalized', u'zolw')))")
+        self.assertEquals(q.value_for_description(u"Żółw"), u'"Żółw"')
+
+        instance = MagicMock(foo=u'ŁÓDŹ')
+        q.normalize_record(instance)
+        self.assertEquals(instance.foo_normalized, u'lodz')
+
+    def test_match(self):
+        q = StringQueryObject('foo', match=MATCH_FULLTEXT)
+        self.assertEquals(
+            str(q.real_query("foobar", CONTAINS)),
+            "(AND: ('foo__multiseek_fulltext', 'foobar'))")
+        self.assertEquals(q.get_matched_field_name(), 'foo')
+
+        # Indexes are needed on the normalized field, which is matched
+        q = StringQueryObject('foo', match=MATCH_FULLTEXT,
+                              normalized_field_name='foo_normalized')
+        self.assertEquals(q.get_matched_field_name(), 'foo_normalized')
+        self.assertEquals(
+            str(q.real_query("foobar", CONTAINS)),
+            "(AND: ('foo_normalized__multiseek_fulltext', 'foobar'))")
+
 
 class TestAutocompleteQueryObject(TestCase):
     def test_value_from_web(self):
@@ -103,6 +140,42 @@ class TestRangeQueryObject(TestCase):
         self.assert_(maybe_that or maybe_this)
 
 
+class TestDateQueryObject(TestCase):
+    def setUp(self):
+        self.q = DateQueryObject('foo')
+
+    def test_real_query(self):
+        day = date(2015, 1, 1)
+        self.assertEquals(
+            sorted(self.q.real_query(day, EQUAL_FEMALE).children),
+            [('foo__gte', day), ('foo__lt', date(2015, 1, 2))])
+        self.assertEquals(
+            self.q.real_query(day, GREATER_FEMALE).children,
+            [('foo__gte', date(2015, 1, 2))])
+        self.assertEquals(
+            str(self.q.real_query(day, DIFFERENT_FEMALE)),
+            "(OR: ('foo__lt', datetime.date(2015, 1, 1)), "
+            "('foo__gte', datetime.date(2015, 1, 2)), ('foo__isnull', True))")
+
+    def test_is_datetime(self):
+        self.q.is_datetime = True
+        with override_settings(USE_TZ=True):
+            value = self.q.to_boundary(date(2015, 1, 1))
+        self.assert_(timezone.is_aware(value))
+        self.assertEquals(value.date(), date(2015, 1, 1))
+
+    def test_merge(self):
+        registry = create_registry(None, self.q)
+        query = registry.get_query([
+            None,
+            make_field(self.q, GREATER_OR_EQUAL_FEMALE, '["2015-01-01"]', None),
+            make_field(self.q, LESSER_FEMALE, '["2015-03-01"]'),
+            make_field(self.q, IN_RANGE, '["2015-02-01", "2015-06-01"]')])
+        self.assertEquals(
+            sorted(query.children),
+            [('foo__gte', date(2015, 2, 1)), ('foo__lt', date(2015, 3, 1))])
+
+
 class TestIntegerQueryObject(TestCase):
     def test_value_from_web(self):
         r = IntegerQueryObject('foo')
@@ -115,6 +188,30 @@ class TestIntegerQueryObject(TestCase):
         self.assertEquals(
             str(res), "(AND: ('foo__lte', 123))")
 
+    def test_in_list(self):
+        self.assertEquals(
+            parse_in_list(u"3, 1\n2;3 -4 5-6"), [-4, 1, 2, 3, 5, 6])
+        self.assertEquals(parse_in_list(None), [])
+
+        r = IntegerQueryObject('foo')
+        self.assertEquals(
+            str(r.query_for(u"2 1", IN_LIST)), "(AND: ('foo__in', [1, 2]))")
+        self.assertEquals(
+            str(r.query_for(u"1", NOT_IN_LIST)),
+            "(NOT (AND: ('foo__in', [1])))")
+        self.assertEquals(r.value_for_description(u"2, 1"), u"1, 2")
+
+        q = AutocompleteQueryObject('bar')
+        self.assertEquals(
+            str(q.query_for(u"1", IN_LIST)), "(AND: ('bar__pk__in', [1]))")
+
+    def test_in_list_threshold(self):
+        r = IntegerQueryObject('foo')
+        values = u" ".join(str(x) for x in range(501))
+        self.assertEquals(
+            r.query_for(values, IN_LIST).children[0][0],
+            'foo__multiseek_in_values')
+
 
 class TestMultiseekRegistry(TestCase):
     def setUp(self):
@@ -131,10 +228,35 @@ class TestMultiseekRegistry(TestCase):
             Ordering("bar", "Bar"),
         ]
 
+    def test_get_ordering_relevance(self):
+        self.registry.ordering.append(Ordering(RELEVANCE, "Relevance"))
+        key, key_dir = get_ordering_key_name(0)
+        self.assertEquals(
+            self.registry.get_ordering(
+                {'ordering': {key: '2', key_dir: '1'}}),
+            ['-' + RELEVANCE])
+
+    def test_get_relevance(self):
+        self.assertEquals(self.registry.get_relevance([None], None), None)
+        self.assertEquals(
+            self.registry.get_relevance([
+                None, dict(field='foo', operator=unicode(NOT_CONTAINS),
+                           value='x', prev_op=None)], None),
+            None)
+
     def test_add_field_raises(self):
         self.assertRaises(
             AssertionError, self.registry.add_field, StringQueryObject('foo'))
 
+    def test_get_autocomplete_field(self):
+        field = AutocompleteQueryObject('baz', model=SearchForm)
+        self.registry.add_field(field)
+
+        self.assertEquals(
+            self.registry.get_autocomplete_field('SearchForm'), field)
+        self.assertEquals(
+            self.registry.get_autocomplete_field('foo'), None)
+
     def test_field_by_type(self):
         self.assertEquals(
             len(self.registry.field_by_type(STRING)),
@@ -225,23 +347,85 @@ class TestMultiseekRegistry(TestCase):
 
         self.maxDiff = None
 
-        ex = u"""$('#frame-0').multiseekFrame('addField', 'foo', 'equals', 'foo', null);
-$('#frame-0').multiseekFrame('addField', 'foo', 'equals', 'foo', 'or');
-$('#frame-0').multiseekFrame('addFrame', 'and');
-$('#frame-1').multiseekFrame('addField', 'foo', 'equals', 'foo', null);
-$('#frame-1').multiseekFrame('addField', 'foo', 'equals', 'foo', 'or');
-$('#frame-0').multiseekFrame('addField', 'foo', 'equals', 'foo', 'and');
-$('#frame-0').multiseekFrame('addFrame', 'or');
-$('#frame-2').multiseekFrame('addField', 'foo', 'equals', 'foo', null);
-$('#frame-2').multiseekFrame('addField', 'foo', 'equals', 'foo', 'or');
-\t\t$("select[name=order_1] option").eq(1).prop("selected", true);
-\t\t$("input[name=order_1_dir]").attr("checked", true);
-\t\t$("select[name=_ms_report_type] option").eq(1).prop("selected", true);
-\t\tif (window.Foundation) {
-\t\t\t$("input[name=order_1_dir]").next().toggleClass("checked", true)
-\t\t}\n""" % dict(equal=EQUAL)
-
-        self.assertEquals(ex, res)
+        self.assertEquals(json.loads(res), {
+            'form_data': [
+                None,
+                fld_noop,
+                fld_or, [
+                    AND,
+                    fld_noop,
+                    fld_or],
+                fld_and,
+                [OR,
+                 fld_noop,
+                 fld_or]
+            ],
+            'ordering': {
+                '%s1' % MULTISEEK_ORDERING_PREFIX: "1",
+                '%s1_dir' % MULTISEEK_ORDERING_PREFIX: "1",
+            },
+            'report_type': '1'})
+
+    def test_recreate_form_escapes_html(self):
+        op = unicode(EQUALITY_OPS_ALL[0])
+        res = self.registry.recreate_form({'form_data': [
+            None, dict(field='foo', operator=op, value=u'</script>',
+                       prev_op=None)]})
+        self.assertNotIn('</script>', res)
+        self.assertEquals(
+            json.loads(res)['form_data'][1]['value'], u'</script>')
+
+    def test_normalize_form(self):
+        op = unicode(EQUALITY_OPS_ALL[0])
+        res = self.registry.normalize_form(
+            {'form_data': [
+                None,
+                dict(field='foo', operator=op, value=u'foo', extra='x'),
+                [OR, dict(field='foo', operator=op, value=u'bar',
+                          prev_op=AND)]],
+             'ordering': {'%s1' % MULTISEEK_ORDERING_PREFIX: 1,
+                          'unknown': 'key'},
+             'report_type': 1})
+
+        self.assertEquals(res, {
+            'form_data': [
+                None,
+                dict(field='foo', operator=op, value='foo', prev_op=None),
+                [OR, dict(field='foo', operator=op, value='bar',
+                          prev_op=AND)]],
+            'ordering': {'%s1' % MULTISEEK_ORDERING_PREFIX: '1'},
+            'report_type': '1'})
+
+    def test_normalize_form_raises(self):
+        op = unicode(EQUALITY_OPS_ALL[0])
+        self.assertRaises(
+            ParseError, self.registry.normalize_form, [None])
+
+        self.assertRaises(
+            ParseError, self.registry.normalize_form,
+            {'form_data': [None, dict(field='foo', value='foo')]})
+
+        self.assertRaises(
+            UnknownField, self.registry.normalize_form,
+            {'form_data': [None, dict(field='XXX', operator=op, value='')]})
+
+        self.assertRaises(
+            UnknownOperation, self.registry.normalize_form,
+            {'form_data': [None, dict(field='foo', operator='XX', value='')]})
+
+        self.assertRaises(
+            ParseError, self.registry.normalize_form,
+            {'form_data': [None, dict(field='foo', operator=op, value='',
+                                      prev_op='lol')]})
+
+    def test_get_query_hash(self):
+        op = unicode(EQUALITY_OPS_ALL[0])
+        fld = dict(field='foo', operator=op, value=u'foo', prev_op=None)
+        a = get_query_hash({'form_data': [None, fld], 'report_type': '1'})
+        b = get_query_hash({'form_data': [None, fld]})
+        c = get_query_hash({'form_data': [None, fld, fld]})
+        self.assertEquals(a, b)
+        self.assertNotEquals(a, c)
 
     def     test_create_registry(self):
         create_registry(None, StringQueryObject('foo'))
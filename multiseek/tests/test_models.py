@@ -1,10 +1,26 @@
 # -*- encoding: utf-8 -*-
+import json
+from datetime import date
 
 from django.contrib.auth.models import AnonymousUser, User
+from django.db.models.query import QuerySet
 from django.test import TransactionTestCase
-from multiseek.models import SearchForm
+from django.utils.timezone import now
+from mock import patch
+from multiseek import models
+from multiseek.models import SearchForm, SlowSearch, FacetCount, \
+    get_model_key
 from model_mommy import mommy
 
+from multiseek.logic import EQUAL, STARTS_WITH, CONTAINS, DIFFERENT, AND, \
+    JOIN, SEMI_JOIN, is_multi_valued, get_ordering_key_name, is_indexed, \
+    RELEVANCE, EQUAL_FEMALE, GREATER_OR_EQUAL_FEMALE, LESSER_FEMALE, \
+    DateQueryObject, create_registry
+from multiseek.util import make_field
+from test_app.models import Book, Author, Language
+from test_app.multiseek_registry import registry, TitleQueryObject, \
+    AuthorQueryObject, LanguageQueryObject
+
 
 class TestModels(TransactionTestCase):
     def test_search_form_manager(self):
@@ -17,4 +33,307 @@ class TestModels(TransactionTestCase):
         self.assertEquals(list(res), [s2])
 
         res = SearchForm.objects.get_for_user(u)
-        self.assertEquals(list(res), [s1, s2])
\ No newline at end of file
+        self.assertEquals(list(res), [s1, s2])
+
+    def test_search_form_manager_names(self):
+        u = mommy.make(User)
+
+        s1 = mommy.make(SearchForm, owner=u, public=False, name='A')
+        s2 = mommy.make(SearchForm, owner=u, public=True, name='B')
+
+        res = SearchForm.objects.get_names_for_user(AnonymousUser())
+        self.assertEquals(res, [(s2.pk, 'B')])
+
+        res = SearchForm.objects.get_names_for_user(u)
+        self.assertEquals(res, [(s1.pk, 'A'), (s2.pk, 'B')])
+
+        # Saving a form invalidates the cached lists
+        s1.public = True
+        s1.save()
+        res = SearchForm.objects.get_names_for_user(AnonymousUser())
+        self.assertEquals(res, [(s1.pk, 'A'), (s2.pk, 'B')])
+
+
+class TestMaterialization(TransactionTestCase):
+    def test_materialize(self):
+        u = mommy.make(User)
+        b1 = mommy.make(Book, title='foo')
+        mommy.make(Book, title='bar')
+
+        data = {'form_data': [
+            None, make_field(TitleQueryObject, EQUAL, 'foo', None)]}
+        sf = SearchForm(name='A', owner=u, materialized=True)
+        sf.set_form_data(json.dumps(data), registry.normalize_form(data))
+        sf.save()
+
+        sf.materialize(registry)
+        self.assertNotEquals(sf.materialized_on, None)
+        self.assertEquals(list(sf.get_materialized_queryset(Book)), [b1])
+
+        # Changing the query makes stored results obsolete
+        data['form_data'][1]['value'] = 'bar'
+        sf.set_form_data(json.dumps(data), registry.normalize_form(data))
+        self.assertEquals(sf.materialized_on, None)
+
+    def test_incremental_update(self):
+        u = mommy.make(User)
+        b1 = mommy.make(Book, title='foo')
+
+        data = {'form_data': [
+            None, make_field(TitleQueryObject, EQUAL, 'foo', None)]}
+        sf = SearchForm(name='A', owner=u, materialized=True)
+        sf.set_form_data(json.dumps(data), registry.normalize_form(data))
+        sf.save()
+        sf.materialize(registry)
+
+        b2 = mommy.make(Book, title='foo')
+        self.assertEquals(
+            list(sf.get_materialized_queryset(Book).order_by('pk')),
+            [b1, b2])
+
+        b1.title = 'bar'
+        b1.save()
+        self.assertEquals(list(sf.get_materialized_queryset(Book)), [b2])
+
+        b2.delete()
+        self.assertEquals(list(sf.get_materialized_queryset(Book)), [])
+
+    def test_legacy_forms(self):
+        u = mommy.make(User)
+        forms = []
+        for title in ['aaa', 'bbb']:
+            # Saved before normalized form data and query hash were stored
+            sf = SearchForm.objects.create(
+                name=title, owner=u, materialized=True,
+                data=json.dumps({'form_data': [None, make_field(
+                    TitleQueryObject, EQUAL, title, None)]}))
+            sf.materialize(registry)
+            self.assertNotEquals(sf.query_hash, '')
+            forms.append(sf)
+
+        SearchForm.objects.update(normalized_data='', query_hash='')
+        b1 = mommy.make(Book, title='aaa')
+        self.assertEquals(
+            list(forms[0].get_materialized_queryset(Book)), [b1])
+        self.assertEquals(list(forms[1].get_materialized_queryset(Book)), [])
+
+    def test_stale_form(self):
+        sf = SearchForm.objects.create(
+            name='A', owner=mommy.make(User), materialized=True,
+            materialized_on=now(), query_hash='stale',
+            data=json.dumps({'form_data': [None, dict(
+                field='no such field', operator=unicode(EQUAL),
+                value='foo', prev_op=None)]}))
+
+        # Saving records does not fail because of the form
+        mommy.make(Book, title='foo')
+        self.assertEquals(list(sf.get_materialized_queryset(Book)), [])
+
+
+class TestNormalizedFields(TransactionTestCase):
+    def test_starts_with(self):
+        b1 = mommy.make(Book, title=u'Django')
+        mommy.make(Book, title=u'Python')
+        self.assertEquals(b1.title_normalized, u'django')
+
+        data = {'form_data': [
+            None, make_field(TitleQueryObject, STARTS_WITH, 'dJA', None)]}
+        self.assertEquals(
+            list(registry.get_query_for_model(data)), [b1])
+
+    def test_starts_with_empty(self):
+        b1 = mommy.make(Book, title=u'Django')
+        data = {'form_data': [
+            None, make_field(TitleQueryObject, STARTS_WITH, u'', None)]}
+        self.assertIn(b1, registry.get_query_for_model(data))
+
+    def test_accents(self):
+        b1 = mommy.make(Book, title=u'Żółw')
+        data = {'form_data': [
+            None, make_field(TitleQueryObject, CONTAINS, u'ZOLW', None)]}
+        self.assertEquals(
+            list(registry.get_query_for_model(data)), [b1])
+
+    def test_autocomplete(self):
+        a1 = mommy.make(Author, first_name=u'Łukasz', last_name=u'Wójcik')
+        mommy.make(Author, first_name=u'Anna', last_name=u'Nowak')
+        self.assertEquals(
+            list(AuthorQueryObject().get_autocomplete_query('luk woj')),
+            [a1])
+
+
+class TestRelevance(TransactionTestCase):
+    def test_relevance(self):
+        books = [mommy.make(Book, title=title) for title in [
+            u'Żółw i zając', u'Zając i jeż', u'Psy', u'Zając']]
+
+        data = {
+            'form_data': [
+                None, make_field(TitleQueryObject, CONTAINS, u'zając', None)],
+            'ordering': {get_ordering_key_name(0)[0]: '4'}}
+        res = registry.get_query_for_model(data)
+        self.assertEquals(
+            [x.title for x in res],
+            [u'Zając', u'Zając i jeż', u'Żółw i zając'])
+
+        # The queryset can still be changed, ie. by SearchForm.materialize
+        self.assertEquals(res.order_by('pk')[0].title, u'Żółw i zając')
+
+        old_limit = registry.relevance_row_limit
+        registry.relevance_row_limit = 2
+        try:
+            self.assertEquals(
+                [x.title for x in registry.limit_relevance(res)],
+                [u'Zając', u'Zając i jeż'])
+        finally:
+            registry.relevance_row_limit = old_limit
+
+        # Without text clauses there is nothing to rank by
+        data['form_data'] = [None]
+        res = registry.get_query_for_model(data)
+        self.assertEquals(
+            res.filter(pk__in=[x.pk for x in books]).count(), 4)
+        self.assertEquals(registry.limit_relevance(res).count(), res.count())
+
+
+class TestIndexed(TransactionTestCase):
+    def test_is_indexed(self):
+        self.assert_(is_indexed(Book, 'id'))
+        self.assert_(is_indexed(Book, '-title_normalized'))
+        self.assert_(is_indexed(Book, 'language'))
+        self.assertFalse(is_indexed(Book, 'title'))
+        self.assertFalse(is_indexed(Book, 'authors'))
+        self.assertFalse(is_indexed(Book, 'language__name'))
+        self.assertFalse(is_indexed(Book, RELEVANCE))
+
+
+class TestMultiValued(TransactionTestCase):
+    def test_is_multi_valued(self):
+        self.assert_(registry.is_multi_valued('authors'))
+        self.assertFalse(registry.is_multi_valued('language__name'))
+        self.assertFalse(registry.is_multi_valued('title'))
+        self.assert_(is_multi_valued(Language, 'book__title'))
+
+    def test_get_join_strategies(self):
+        self.assertEquals(
+            registry.get_join_strategies([
+                None,
+                make_field(TitleQueryObject, EQUAL, 'foo', None),
+                [AND, make_field(AuthorQueryObject, EQUAL, 1, None)],
+                make_field(LanguageQueryObject, EQUAL, 'polish')]),
+            [SEMI_JOIN, JOIN])
+
+    def test_semi_join(self):
+        a1, a2, a3 = mommy.make(Author, _quantity=3)
+        b1 = mommy.make(Book)
+        b1.authors.add(a1, a2)
+        b2 = mommy.make(Book)
+        b2.authors.add(a1, a3)
+
+        data = {'form_data': [
+            None,
+            make_field(AuthorQueryObject, EQUAL, a1.pk, None),
+            make_field(AuthorQueryObject, EQUAL, a2.pk, AND)]}
+        queryset = registry.get_query_for_model(data)
+        self.assertEquals(list(queryset), [b1])
+        self.assertNotIn('JOIN', str(queryset.query).split('WHERE')[0])
+
+        data['form_data'][2]['operator'] = unicode(DIFFERENT)
+        self.assertEquals(list(registry.get_query_for_model(data)), [b2])
+
+    def test_semi_join_dates(self):
+        a1 = mommy.make(Author)
+        b1, b2 = mommy.make(Book, _quantity=2)
+        b1.authors.add(a1)
+        b2.authors.add(a1)
+        Book.objects.filter(pk__in=[b1.pk, b2.pk]).update(
+            last_updated=date(2010, 1, 1))
+
+        q = DateQueryObject('book__last_updated')
+        author_registry = create_registry(Author, q)
+        data = {'form_data': [
+            None, make_field(q, EQUAL_FEMALE, '["2010-01-01"]', None)]}
+        self.assertEquals(
+            list(author_registry.get_query_for_model(data)), [a1])
+
+        # Every clause may match a different book
+        Book.objects.filter(pk=b2.pk).update(last_updated=date(2020, 1, 1))
+        data = {'form_data': [
+            None,
+            make_field(q, GREATER_OR_EQUAL_FEMALE, '["2015-01-01"]', None),
+            make_field(q, LESSER_FEMALE, '["2012-01-01"]', AND)]}
+        self.assertEquals(
+            list(author_registry.get_query_for_model(data)), [a1])
+
+
+class TestSlowSearch(TransactionTestCase):
+    def test_log(self):
+        old_size = models.SLOW_SEARCH_LOG_SIZE
+        models.SLOW_SEARCH_LOG_SIZE = 2
+        try:
+            for no in range(3):
+                SlowSearch.objects.log(
+                    duration=no, page_row_count=no, query_hash='x',
+                    form_data='{}', sql='SELECT 1', ordering='[]')
+        finally:
+            models.SLOW_SEARCH_LOG_SIZE = old_size
+
+        self.assertEquals(
+            sorted(SlowSearch.objects.values_list('duration', flat=True)),
+            [1, 2])
+
+
+class TestFacetCounts(TransactionTestCase):
+    def facets(self):
+        return dict(
+            (label, dict(counts)) for label, counts in
+            FacetCount.objects.get_facets(
+                registry, registry.get_facet_fields()))
+
+    def test_facet_counts(self):
+        # Only count the books made below, not the fixture ones
+        Book.objects.all().delete()
+        polish = mommy.make(Language, name='polish')
+        english = mommy.make(Language, name='english')
+        b1 = mommy.make(Book, language=polish, available=True)
+        mommy.make(Book, language=polish, available=False)
+        self.assertEquals(self.facets(), {
+            u'Language': {u'polish': 2},
+            u'Available': {u'yes': 1, u'no': 1}})
+
+        b1.language = english
+        b1.save()
+        self.assertEquals(
+            self.facets()[u'Language'], {u'polish': 1, u'english': 1})
+
+        b1.delete()
+        self.assertEquals(self.facets(), {
+            u'Language': {u'polish': 1},
+            u'Available': {u'no': 1}})
+
+        FacetCount.objects.all().delete()
+        FacetCount.objects.rebuild(registry)
+        self.assertEquals(self.facets(), {
+            u'Language': {u'polish': 1},
+            u'Available': {u'no': 1}})
+
+    def test_concurrent_create(self):
+        FacetCount.objects.create(
+            model=get_model_key(Book), field='available', value='true',
+            count=1)
+
+        update = QuerySet.update
+        calls = []
+
+        def concurrent_update(queryset, **kwargs):
+            # The first update runs before a concurrent save creates the row
+            calls.append(kwargs)
+            if len(calls) == 1:
+                return 0
+            return update(queryset, **kwargs)
+
+        with patch.object(QuerySet, 'update', concurrent_update):
+            FacetCount.objects.update_counts(
+                registry, {}, {'available': set([True])})
+        self.assertEquals(
+            FacetCount.objects.get(field='available', value='true').count, 2)
@@ -2,20 +2,31 @@
 import json
 
 from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import cache
+from django.core.cache.backends.dummy import DummyCache
 from django.test import TestCase
 from django.test.client import RequestFactory
-from mock import MagicMock
+from django.utils import translation
+from django.utils.timezone import now
+from contextlib import contextmanager
+
+from mock import MagicMock, patch
 from model_mommy import mommy
 
 from multiseek.logic import create_registry, StringQueryObject, \
-    ValueListQueryObject, AutocompleteQueryObject, EQUALITY_OPS_ALL, EQUAL
-from multiseek.models import SearchForm
+    ValueListQueryObject, AutocompleteQueryObject, EQUALITY_OPS_ALL, EQUAL, \
+    COST_REFUSE, COST_LIMIT, COST_BACKGROUND
+from multiseek.models import SearchForm, SlowSearch
+from multiseek.signals import search_phase
 from multiseek.views import MultiseekFormPage, MULTISEEK_SESSION_KEY, \
     reset_form, get_registry, user_allowed_to_save_forms, MultiseekSaveForm, \
     ERR_NO_FORM_DATA, ERR_PARSING_DATA, ERR_LOADING_DATA, ERR_FORM_NAME, \
-    OVERWRITE_PROMPT, SAVED, load_form, MultiseekResults
+    OVERWRITE_PROMPT, SAVED, load_form, MultiseekResults, \
+    MULTISEEK_SESSION_KEY_MATERIALIZED, ERR_QUERY_TOO_EXPENSIVE, \
+    ERR_QUERY_TIMEOUT, ERR_SEARCH_JOB_FAILED, MULTISEEK_SESSION_KEY_JOB
+from multiseek.db import QueryTimeout
 from test_app import multiseek_registry
-from test_app.models import Author
+from test_app.models import Author, Book, Language
 
 
 class Session(dict):
@@ -64,8 +75,9 @@ class TestViews(RegistryMixin, TestCase):
         self.assertEquals(ret['js_autocompletes'], '{"quux": "/LOL/"}')
         self.assertEquals(ret['js_value_lists'], '{"baz": ["a", "b", "c"]}')
         self.assertEquals(
-            ret['js_init'],
-            u"$('#frame-0').multiseekFrame('addField', 'foo', 'equals', 'foo', 'or');\n")
+            json.loads(ret['js_init']),
+            {'form_data': [None, dict(
+                field="foo", operator="equals", value="foo", prev_op="or")]})
 
     def test_reset_form(self):
         self.request.session[MULTISEEK_SESSION_KEY] = '123'
@@ -155,6 +167,26 @@ class TestMultiseekSaveForm(RegistryMixin, TestCase):
         self.msp.get_context_data()
         self.assertEquals(SearchForm.objects.all()[0].public, True)
 
+    def test_get_context_data_normalizes(self):
+        self.request.POST = {
+            'name': 'foo',
+            'json': json.dumps({'form_data': [
+                None,
+                {'field': 'foo', 'operator': unicode(EQUAL), 'value': 'foo',
+                 'junk': 'data'}]})}
+        self.request.user = mommy.make(User)
+        self.assertEquals(self.msp.get_context_data()['result'], SAVED)
+
+        sf = SearchForm.objects.get(name='foo')
+        self.assertEquals(sf.data, self.request.POST['json'])
+        self.assertEquals(
+            json.loads(sf.get_form_data()),
+            {'form_data': [
+                None,
+                {'field': 'foo', 'operator': unicode(EQUAL), 'value': 'foo',
+                 'prev_op': None}]})
+        self.assertEquals(len(sf.query_hash), 40)
+
 
 class TestMultiseekLoadForm(TestCase):
     def setUp(self):
@@ -179,6 +211,32 @@ class TestMultiseekLoadForm(TestCase):
             self.anon_req.session[MULTISEEK_SESSION_KEY],
             sf.data)
 
+    def test_load_form_normalized(self):
+        sf = SearchForm.objects.create(
+            name='foo', owner=self.user, public=True, data='some data')
+        sf.set_form_data('some data', {'form_data': [None]})
+        sf.save()
+        load_form(self.anon_req, sf.pk)
+        self.assertEquals(
+            self.anon_req.session[MULTISEEK_SESSION_KEY],
+            '{"form_data": [null]}')
+
+    def test_load_form_materialized(self):
+        sf = SearchForm.objects.create(
+            name='foo', owner=self.user, public=True, data='some data',
+            materialized=True, materialized_on=now(), query_hash='x')
+        load_form(self.anon_req, sf.pk)
+        self.assertEquals(
+            self.anon_req.session[MULTISEEK_SESSION_KEY_MATERIALIZED],
+            [sf.pk, 'x'])
+
+        mr = MultiseekResults(registry=multiseek_registry.registry)
+        mr.request = self.anon_req
+        self.assertEquals(mr.get_materialized_form(), sf)
+
+        SearchForm.objects.filter(pk=sf.pk).update(query_hash='y')
+        self.assertEquals(mr.get_materialized_form(), None)
+
     def test_load_form_forbidden(self):
         sf = SearchForm.objects.create(
             name='foo', owner=self.user, public=False, data='some data')
@@ -210,3 +268,192 @@ class TestMultiseekResults(RegistryMixin, TestCase):
 
     def test_get_queryset(self):
         res = self.mr.get_queryset()
+
+    def test_search_phase_signal(self):
+        phases = []
+
+        def receiver(sender, phase, duration, queries, **kwargs):
+            phases.append(phase)
+
+        search_phase.connect(receiver)
+        try:
+            self.mr.post(self.request)
+        finally:
+            search_phase.disconnect(receiver)
+
+        self.assertEquals(
+            phases, ['parse', 'compile', 'execute', 'render'])
+        self.assertIn('render;dur=', self.mr.timings.as_server_timing())
+
+    def test_slow_search_log(self):
+        self.mr.post(self.request)
+        self.assertEquals(SlowSearch.objects.count(), 0)
+
+        self.registry.slow_search_threshold = 0
+        self.mr.post(self.request)
+        self.assertEquals(SlowSearch.objects.count(), 1)
+
+    def test_query_cost_guard(self):
+        self.registry.max_query_cost = 10
+        self.registry.get_query_cost_action = MagicMock(
+            return_value=COST_REFUSE)
+        self.mr.post(self.request)
+        self.assertEquals(self.mr.error_message, ERR_QUERY_TOO_EXPENSIVE)
+        self.assertEquals(self.mr.row_limit, None)
+
+        self.mr.error_message = None
+        self.registry.get_query_cost_action.return_value = COST_LIMIT
+        self.mr.post(self.request)
+        self.assertEquals(self.mr.error_message, None)
+        self.assertEquals(self.mr.row_limit, 1000)
+
+    def test_background_search(self):
+        self.registry.max_query_cost = 10
+        self.registry.get_query_cost_action = MagicMock(
+            return_value=COST_BACKGROUND)
+
+        job = dict(id='foo', status='running', count=0, pages=0)
+        with patch('multiseek.views.start_search', return_value=job):
+            self.mr.post(self.request)
+        self.assertEquals(self.mr.job, job)
+        job_id, key = self.request.session[MULTISEEK_SESSION_KEY_JOB]
+        self.assertEquals(job_id, 'foo')
+
+        # The job is reused, no matter what its cost would be
+        self.registry.get_query_cost_action.reset_mock()
+        job = dict(job, status='done', count=1, pages=1)
+        with patch('multiseek.views.get_job', return_value=job), \
+                patch('multiseek.views.get_job_page', return_value=[1]):
+            self.mr.get(self.request)
+        self.assertEquals(self.mr.job, job)
+        self.assertFalse(self.registry.get_query_cost_action.called)
+
+        # A failed job is reported, not started again
+        job = dict(job, status='failed')
+        with patch('multiseek.views.get_job', return_value=job), \
+                patch('multiseek.views.start_search') as start_search:
+            self.mr.get(self.request)
+        self.assertEquals(self.mr.error_message, ERR_SEARCH_JOB_FAILED)
+        self.assertEquals(self.mr.job, None)
+        self.assertFalse(start_search.called)
+
+    def test_statement_timeout(self):
+        @contextmanager
+        def timeout(seconds, using):
+            yield
+            raise QueryTimeout()
+
+        with patch('multiseek.views.statement_timeout', timeout):
+            self.mr.post(self.request)
+
+        self.assertEquals(self.mr.error_message, ERR_QUERY_TIMEOUT)
+        self.assertEquals(self.mr.timings.events, ['timeout'])
+
+
+class TestMultiseekResultsPages(TestCase):
+    def get_response(self, url, **extra):
+        request = setup_anonymous_session(RequestFactory().get(url, **extra))
+        mr = MultiseekResults(registry=multiseek_registry.registry)
+        mr.request = request
+        return mr.get(request)
+
+    def get(self, url):
+        return self.get_response(url).context_data
+
+    def test_pages(self):
+        Book.objects.all().delete()
+        mommy.make(Book, _quantity=3)
+
+        with patch.object(multiseek_registry.registry, 'page_size', 2):
+            context = self.get('/')
+            self.assertEquals(len(context['object_list']), 2)
+            self.assertTrue(context['has_more'])
+
+            context = self.get('/?page=2')
+            self.assertEquals(len(context['object_list']), 1)
+            self.assertFalse(context['has_more'])
+
+    def test_facets(self):
+        cache.clear()
+        # Only count the books made below, not the fixture ones
+        Book.objects.all().delete()
+        polish = mommy.make(Language, name='polish')
+        mommy.make(Book, language=polish, available=True, _quantity=2)
+        mommy.make(Book, language=polish, available=False)
+
+        facets = [(u'Language', [(u'polish', 3)]),
+                  (u'Available', [(u'yes', 2), (u'no', 1)])]
+        # From stored counts
+        self.assertEquals(self.get('/')['facets'], facets)
+
+        with patch.object(
+                multiseek_registry.registry, 'facet_rollup', False):
+            self.assertEquals(self.get('/')['facets'], facets)
+
+            # Cached, until records are saved or deleted
+            Book.objects.update(available=True)
+            self.assertEquals(self.get('/')['facets'], facets)
+
+            # Labels are translated, so they are cached per language
+            with patch('multiseek.views.get_language', return_value='pl'):
+                self.assertEquals(
+                    self.get('/')['facets'][1], (u'Available', [(u'yes', 3)]))
+
+            Book.objects.all().delete()
+            self.assertEquals(self.get('/')['facets'], [
+                (u'Language', []), (u'Available', [])])
+
+    def test_facets_without_form_data(self):
+        cache.clear()
+        mr = MultiseekResults(registry=multiseek_registry.registry)
+        mr.request = setup_anonymous_session(RequestFactory().get('/'))
+        with patch.object(
+                multiseek_registry.registry, 'facet_rollup', False):
+            self.assertEquals(
+                mr.get_facets({'form_data': None}, True)[0],
+                (u'Language', [(u'english', 2)]))
+
+    def test_cached_rows(self):
+        cache.clear()
+        book = mommy.make(Book, title=u'Django')
+
+        def row():
+            return [x for x in self.get('/')['object_list']
+                    if x.pk == book.pk][0].multiseek_row
+
+        self.assertIn(u'Django', row())
+
+        # Without signals, the cached row is stale
+        Book.objects.filter(pk=book.pk).update(title=u'Python')
+        self.assertIn(u'Django', row())
+
+        # Rows are cached per language
+        with translation.override('pl'):
+            self.assertIn(u'Python', row())
+
+        book.title = u'Flask'
+        book.save()
+        self.assertIn(u'Flask', row())
+        with translation.override('pl'):
+            self.assertIn(u'Flask', row())
+
+    def test_etag(self):
+        self.assertFalse(self.get_response('/').has_header('ETag'))
+
+        with patch.object(multiseek_registry.registry, 'etag', True):
+            etag = self.get_response('/')['ETag']
+            self.assertEquals(
+                self.get_response('/', HTTP_IF_NONE_MATCH=etag).status_code,
+                304)
+            self.assertNotEquals(
+                self.get_response('/?page=2')['ETag'], etag)
+
+            # Records changed
+            mommy.make(Book)
+            self.assertEquals(
+                self.get_response('/', HTTP_IF_NONE_MATCH=etag).status_code,
+                200)
+
+            # Versions of records are not kept by the cache
+            with patch('multiseek.models.cache', DummyCache('dummy', {})):
+                self.assertFalse(self.get_response('/').has_header('ETag'))
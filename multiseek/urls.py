@@ -31,6 +31,10 @@ urlpatterns = patterns(
             template_name="multiseek/results.html"
         )), name="results"),
 
+    url(r'^results/job/(?P<job_id>\w+)/$',
+        views.job_status,
+        name="job_status"),
+
     url(r'^save_form/$',
         csrf_exempt(views.MultiseekSaveForm.as_view(
             registry=settings.MULTISEEK_REGISTRY
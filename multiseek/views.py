@@ -1,21 +1,41 @@
 # -*- encoding: utf-8 -*-
+import hashlib
 import json
 
 from django.http.response import HttpResponse, Http404, HttpResponseServerError, \
     HttpResponseRedirect
 from django.views.generic.base import View
 from django import shortcuts, http
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
 from django.db import transaction
-from django.http import HttpResponseForbidden, HttpResponseNotFound
+from django.http import HttpResponseForbidden, HttpResponseNotFound, \
+    HttpResponseNotModified
 from django.views.generic import TemplateView, ListView
-from django.utils.translation import ugettext_lazy as _, ugettext_lazy
+from django.conf import settings
+from django.template.loader import render_to_string
+from django.utils.http import parse_etags, quote_etag
+from django.utils.safestring import mark_safe
+from django.utils.translation import ugettext_lazy as _, ugettext_lazy, \
+    get_language
 
 import simplejson
 from .logic import VALUE_LIST, AUTOCOMPLETE, AND, OR, get_registry, \
-    UnknownOperation, ParseError, UnknownField, MULTISEEK_ORDERING_PREFIX
-from multiseek.logic import MULTISEEK_REPORT_TYPE
-from multiseek.models import SearchForm
+    UnknownOperation, ParseError, UnknownField, MULTISEEK_ORDERING_PREFIX, \
+    get_query_hash, IN_LIST_OPS
+from multiseek.logic import MULTISEEK_REPORT_TYPE, COST_REFUSE, COST_LIMIT, \
+    COST_BACKGROUND
+from multiseek.instrumentation import SearchTimings, PARSE, COMPILE, \
+    EXPLAIN, EXECUTE, FACETS, RENDER, TIMEOUT
+from multiseek.db import statement_timeout, QueryTimeout
+from multiseek.jobs import start_search, get_job, get_job_page, FAILED
+from multiseek.models import SearchForm, SlowSearch, FacetCount, \
+    get_row_cache_keys, ROW_CACHE_TIMEOUT, get_data_version
+
+try:
+    from django.db.models.sql.datastructures import EmptyResultSet
+except ImportError:
+    from django.core.exceptions import EmptyResultSet
 
 
 SAVED = 'saved'
@@ -25,9 +45,26 @@ ERR_FORM_NAME = _("Form name must not be empty")
 ERR_LOADING_DATA = _("Error while loading form data")
 ERR_PARSING_DATA = _("Error while parsing form data")
 ERR_NO_FORM_DATA = _("No form data provided")
+ERR_QUERY_TIMEOUT = _(
+    "This search took too long and was cancelled. Please refine it, for "
+    "example by adding more conditions.")
+ERR_QUERY_TOO_EXPENSIVE = _(
+    "This search would take too long. Please refine it, for example by "
+    "adding more conditions.")
+ERR_SEARCH_JOB_FAILED = _("Error while searching. Please try again later.")
 
 MULTISEEK_SESSION_KEY = 'multiseek_json'
 MULTISEEK_SESSION_KEY_REMOVED = 'multiseek_json_removed'
+MULTISEEK_SESSION_KEY_MATERIALIZED = 'multiseek_materialized'
+MULTISEEK_SESSION_KEY_JOB = 'multiseek_job'
+
+# Should MultiseekResults return timings of search phases in
+# a Server-Timing HTTP header?
+MULTISEEK_SERVER_TIMING = getattr(settings, 'MULTISEEK_SERVER_TIMING', False)
+
+# For how many seconds should facet counts of a search be cached
+MULTISEEK_FACETS_TIMEOUT = getattr(settings, 'MULTISEEK_FACETS_TIMEOUT', 300)
+FACETS_CACHE_KEY = 'multiseek_facets_%s'
 
 
 def reverse_or_just_url(s):
@@ -65,6 +102,7 @@ class MultiseekFormPage(MultiseekPageMixin, TemplateView):
         js_fields = json.dumps([unicode(x.label) for x in fields])
         js_ops = json.dumps(dict(
             [(unicode(f.label), [unicode(x) for x in f.ops]) for f in fields]))
+        js_in_list_ops = json.dumps([unicode(x) for x in IN_LIST_OPS])
         js_types = json.dumps(
             dict([(unicode(f.label), f.type) for f in fields]))
 
@@ -88,7 +126,8 @@ class MultiseekFormPage(MultiseekPageMixin, TemplateView):
         js_removed = ",".join('"%s"' %x for x in self.request.session.get(MULTISEEK_SESSION_KEY_REMOVED, []))
 
         return dict(
-            js_fields=js_fields, js_ops=js_ops, js_types=js_types,
+            js_fields=js_fields, js_ops=js_ops,
+            js_in_list_ops=js_in_list_ops, js_types=js_types,
             js_autocompletes=js_autocompletes, js_value_lists=js_value_lists,
             js_and=AND, js_or=OR, js_init=js_init,
             js_remove_message=LAST_FIELD_REMOVE_MESSAGE,
@@ -99,13 +138,16 @@ class MultiseekFormPage(MultiseekPageMixin, TemplateView):
             order_boxes=registry.order_boxes,
             ordering=registry.ordering,
             report_types=registry.get_report_types(only_public=public),
-            saved_forms=SearchForm.objects.get_for_user(self.request.user),
+            saved_forms=SearchForm.objects.get_names_for_user(
+                self.request.user),
             MULTISEEK_ORDERING_PREFIX=MULTISEEK_ORDERING_PREFIX,
             MULTISEEK_REPORT_TYPE=MULTISEEK_REPORT_TYPE)
 
 
 def reset_form(request):
-    for key in [MULTISEEK_SESSION_KEY, MULTISEEK_SESSION_KEY_REMOVED]:
+    for key in [MULTISEEK_SESSION_KEY, MULTISEEK_SESSION_KEY_REMOVED,
+                MULTISEEK_SESSION_KEY_MATERIALIZED,
+                MULTISEEK_SESSION_KEY_JOB]:
         if request.session.has_key(key):
             del request.session[key]
     return shortcuts.redirect("..")
@@ -120,7 +162,14 @@ def load_form(request, search_form_pk):
     if request.user.is_anonymous() and not sf.public:
         return HttpResponseForbidden()
 
-    request.session[MULTISEEK_SESSION_KEY] = sf.data
+    request.session[MULTISEEK_SESSION_KEY] = sf.get_form_data()
+
+    if sf.materialized and sf.materialized_on is not None:
+        request.session[MULTISEEK_SESSION_KEY_MATERIALIZED] = [
+            sf.pk, sf.query_hash]
+    elif request.session.has_key(MULTISEEK_SESSION_KEY_MATERIALIZED):
+        del request.session[MULTISEEK_SESSION_KEY_MATERIALIZED]
+
     return shortcuts.redirect("..")
 
 
@@ -155,12 +204,12 @@ class MultiseekSaveForm(MultiseekPageMixin, JSONResponseMixin, TemplateView):
             return dict(result=unicode(ERR_NO_FORM_DATA))
 
         try:
-            json.loads(_json)
+            data = json.loads(_json)
         except ValueError:
             return dict(result=unicode(ERR_PARSING_DATA))
 
         try:
-            get_registry(self.registry).recreate_form(json.loads(_json))
+            normalized = get_registry(self.registry).normalize_form(data)
         except (TypeError, UnknownField, ParseError, UnknownOperation):
             return dict(result=unicode(ERR_LOADING_DATA))
 
@@ -173,28 +222,129 @@ class MultiseekSaveForm(MultiseekPageMixin, JSONResponseMixin, TemplateView):
 
             obj = SearchForm.objects.get(name=name)
             obj.public = public
-            obj.data = _json
             obj.owner = self.request.user
-            obj.save()
 
         else:
-            obj = SearchForm.objects.create(
-                name=name, public=public, data=_json, owner=self.request.user)
+            obj = SearchForm(
+                name=name, public=public, owner=self.request.user)
+
+        obj.set_form_data(_json, normalized)
+        obj.save()
 
         return dict(result=SAVED, pk=obj.pk)
 
 
 class MultiseekResults(MultiseekPageMixin, ListView):
     registry = None
+    template_name = "multiseek/results.html"
     _json_cache = None
+    materialized_form = None
+    timings = None
+    error_message = None
+    row_limit = None
+    job = None
+
+    def phase(self, name):
+        """Measure a phase of the search, see SearchTimings."""
+        if self.timings is None:
+            self.timings = SearchTimings(self, self.request)
+        return self.timings.phase(name)
+
+    def get(self, request, *args, **kwargs):
+        self.timings = SearchTimings(self, request)
+
+        etag = self.get_etag()
+        if etag is not None and etag in parse_etags(
+                request.META.get('HTTP_IF_NONE_MATCH', '')):
+            response = HttpResponseNotModified()
+            response['ETag'] = quote_etag(etag)
+            return response
+
+        response = super(MultiseekResults, self).get(request, *args, **kwargs)
+
+        with self.phase(RENDER):
+            response.render()
+
+        if etag is not None and self.error_message is None and \
+                self.job is None:
+            response['ETag'] = quote_etag(etag)
+
+        if MULTISEEK_SERVER_TIMING:
+            response['Server-Timing'] = self.timings.as_server_timing()
+        return response
+
+    def get_etag(self):
+        """Returns an ETag of the results page, computed from the search
+        (query, ordering, report type, removed records and page), the
+        user's language and the version of the records (see
+        multiseek.models.get_data_version), or None, if the registry has
+        ETags disabled, the page changes on its own (background jobs,
+        stored results) or the cache does not keep versions of records."""
+        registry = get_registry(self.registry)
+        if not registry.etag:
+            return
+
+        session = self.request.session
+        if session.get(MULTISEEK_SESSION_KEY_MATERIALIZED) or \
+                session.get(MULTISEEK_SESSION_KEY_JOB):
+            return
+
+        version = get_data_version(registry.model)
+        if version is None:
+            # Changes of the records can't be told
+            return
+
+        data = self.get_multiseek_data()
+        public = self.request.user.is_anonymous()
+        return hashlib.sha1(json.dumps([
+            get_query_hash(data), registry.get_ordering(data),
+            registry.get_report_type(data, only_public=public),
+            sorted(self.get_removed_records()), self.get_page_number(),
+            public, get_language(), version],
+            sort_keys=True)).hexdigest()
 
     def post(self, request, *args, **kwargs):
         if 'json' in request.POST:
             j = request.POST['json']
             session = request.session
             session[MULTISEEK_SESSION_KEY] = j
+            if session.has_key(MULTISEEK_SESSION_KEY_MATERIALIZED) and \
+                    not self.matches_materialized_form(j):
+                del session[MULTISEEK_SESSION_KEY_MATERIALIZED]
             session.save()
-        return super(MultiseekResults, self).get(request, *args, **kwargs)
+        return self.get(request, *args, **kwargs)
+
+    def matches_materialized_form(self, _json):
+        """Returns True if the query of form data sent by the user is the
+        same as the query of materialized form loaded by the user, so
+        stored results can still be used. Ordering and report type can
+        differ."""
+        try:
+            normalized = get_registry(self.registry).normalize_form(
+                json.loads(_json))
+        except (ValueError, TypeError, UnknownField, ParseError,
+                UnknownOperation):
+            return False
+
+        pk, query_hash = self.request.session[
+            MULTISEEK_SESSION_KEY_MATERIALIZED]
+        return get_query_hash(normalized) == query_hash
+
+    def get_materialized_form(self):
+        """Returns materialized SearchForm loaded by the user, if its
+        stored results can be served instead of running the query."""
+        materialized = self.request.session.get(
+            MULTISEEK_SESSION_KEY_MATERIALIZED)
+        if materialized is None:
+            return
+
+        pk, query_hash = materialized
+        try:
+            return SearchForm.objects.defer('data', 'normalized_data').get(
+                pk=pk, query_hash=query_hash, materialized=True,
+                materialized_on__isnull=False)
+        except SearchForm.DoesNotExist:
+            return
 
     def get_multiseek_data(self):
         if not self._json_cache:
@@ -210,6 +360,125 @@ class MultiseekResults(MultiseekPageMixin, ListView):
     def get_removed_records(self):
         return self.request.session.get(MULTISEEK_SESSION_KEY_REMOVED, [])
 
+    def get_page_number(self):
+        """Returns number of the requested page of results, counting
+        from 1."""
+        try:
+            return max(int(self.request.GET.get('page', 1)), 1)
+        except ValueError:
+            return 1
+
+    def get_page(self, queryset):
+        """Returns a queryset limited to records on the requested page of
+        results and one more, so the view knows if there is a next page
+        without counting all the results."""
+        registry = get_registry(self.registry)
+        queryset = registry.limit_relevance(queryset)
+        start = (self.get_page_number() - 1) * registry.page_size
+        return queryset[start:start + registry.page_size + 1]
+
+    def get_job_key(self, data):
+        """Returns a key identifying results of a background search job.
+        Records removed by hand are excluded from the results when
+        displaying them, so they are not a part of the key."""
+        registry = get_registry(self.registry)
+        return hashlib.sha1(json.dumps(
+            [data.get('form_data'), registry.get_ordering(data)],
+            sort_keys=True)).hexdigest()
+
+    def get_job(self, data):
+        """Returns the background search job started by the user for
+        this search, if it's still there. A failed job is returned too, so
+        it is not started again on every reload."""
+        stored = self.request.session.get(MULTISEEK_SESSION_KEY_JOB)
+        if stored is None:
+            return
+
+        job_id, key = stored
+        if key != self.get_job_key(data):
+            return
+
+        return get_job(job_id)
+
+    def start_job(self, data):
+        registry = get_registry(self.registry)
+        job = start_search(
+            registry.limit_relevance(registry.get_query_for_model(data)))
+        self.request.session[MULTISEEK_SESSION_KEY_JOB] = [
+            job['id'], self.get_job_key(data)]
+        return job
+
+    def get_job_queryset(self):
+        """Returns a queryset limited to records on the requested page of
+        results of the background search job."""
+        page = get_job_page(self.job['id'], self.get_page_number() - 1)
+        if page is None:
+            page = []
+        return get_registry(self.registry).model.objects.filter(pk__in=page)
+
+    def get_facets(self, data, public):
+        """Returns facet counts (see MultiseekRegistry.get_facets) of all
+        results of the search. They are cached, so refining the search
+        does not run them again for the same results."""
+        registry = get_registry(self.registry)
+        fields = registry.get_facet_fields(public)
+        if not fields:
+            return []
+
+        removed = sorted(self.get_removed_records())
+        if registry.facet_rollup and not removed and \
+                registry.get_query(data.get('form_data') or [None]) is None:
+            # Search without conditions, stored counts are up to date
+            return FacetCount.objects.get_facets(registry, fields)
+
+        # Labels are translated and counts change with the records
+        key = FACETS_CACHE_KEY % hashlib.sha1(json.dumps(
+            [get_query_hash(data), removed, public, get_language(),
+             get_data_version(registry.model)])).hexdigest()
+
+        facets = cache.get(key)
+        if facets is None:
+            # Ordering does not matter for the counts
+            query_data = {}
+            if data.get('form_data') is not None:
+                query_data['form_data'] = data['form_data']
+            facets = registry.get_facets(
+                registry.get_query_for_model(query_data, removed), fields)
+            cache.set(key, facets, MULTISEEK_FACETS_TIMEOUT)
+        return facets
+
+    def render_rows(self, object_list, report_type):
+        """Set multiseek_row attribute of every record to its row of
+        results, rendered with multiseek/row_<report type>.html or
+        multiseek/row.html template. If cache_rows of the registry is
+        enabled, rows are fetched from the cache at once and only missing
+        ones are rendered."""
+        registry = get_registry(self.registry)
+        templates = ['multiseek/row_%s.html' % report_type,
+                     'multiseek/row.html']
+
+        keys = []
+        cached = {}
+        if registry.cache_rows and object_list:
+            keys = get_row_cache_keys(
+                registry.model, report_type, [x.pk for x in object_list])
+            cached = cache.get_many(keys)
+
+        missing = {}
+        for no, element in enumerate(object_list):
+            key = keys[no] if keys else None
+            if key in cached:
+                element.multiseek_row = mark_safe(cached[key])
+                continue
+
+            element.multiseek_row = render_to_string(
+                templates, {'element': element, 'report_type': report_type})
+            if key is not None:
+                missing[key] = unicode(element.multiseek_row)
+
+        if missing:
+            cache.set_many(missing, ROW_CACHE_TIMEOUT)
+
     def describe_multiseek_data(self):
         """Returns a string with a nicely-formatted query, so you can
         display the query to the user, in a results window, for example.
@@ -264,34 +533,163 @@ class MultiseekResults(MultiseekPageMixin, ListView):
         return _recur(data['form_data'][1:])
 
     def get_context_data(self, **kwargs):
+        # Run the query here, not while rendering the template, so its
+        # duration can be measured
+        registry = get_registry(self.registry)
+
+        with self.phase(EXECUTE):
+            try:
+                with statement_timeout(registry.statement_timeout,
+                                       self.object_list.db):
+                    len(self.object_list)
+            except QueryTimeout:
+                self.error_message = ERR_QUERY_TIMEOUT
+                self.object_list = self.object_list.none()
+                self.timings.event(TIMEOUT)
+
+        object_list = list(self.object_list)
+        has_more = False
+        if self.job is None and len(object_list) > registry.page_size:
+            has_more = True
+            object_list = object_list[:registry.page_size]
+
+        threshold = registry.slow_search_threshold
+        if threshold is not None:
+            duration = self.timings.total(EXECUTE)
+            if duration >= threshold:
+                self.log_slow_search(duration, len(object_list))
+
         public = self.request.user.is_anonymous()
         report_type = get_registry(self.registry) \
             .get_report_type(self.get_multiseek_data(),
                              only_public=public)
         description = self.describe_multiseek_data()
         removed_ids = self.get_removed_records()
+        self.render_rows(object_list, report_type)
+
+        materialized_on = None
+        if self.materialized_form is not None:
+            materialized_on = self.materialized_form.materialized_on
+
+        facets = []
+        if registry.get_facet_fields(public) and \
+                self.materialized_form is None and self.job is None and \
+                self.row_limit is None and self.error_message is None:
+            # Not for expensive searches
+            with self.phase(FACETS):
+                facets = self.get_facets(self.get_multiseek_data(), public)
 
         return super(ListView, self).get_context_data(
             report_type=report_type, description=description,
-            removed_ids=removed_ids, **kwargs)
+            removed_ids=removed_ids, materialized_on=materialized_on,
+            error_message=self.error_message, row_limit=self.row_limit,
+            job=self.job, page=self.get_page_number(), has_more=has_more,
+            object_list=object_list, facets=facets, **kwargs)
+
+    def log_slow_search(self, duration, page_row_count):
+        registry = get_registry(self.registry)
+        data = self.get_multiseek_data()
+
+        try:
+            form_data = registry.normalize_form(data)
+        except (TypeError, UnknownField, ParseError, UnknownOperation):
+            form_data = data
+
+        try:
+            sql = unicode(self.object_list.query)
+        except EmptyResultSet:
+            sql = u''
+
+        SlowSearch.objects.log(
+            duration=duration,
+            page_row_count=page_row_count,
+            query_hash=get_query_hash(form_data),
+            form_data=json.dumps(form_data),
+            sql=sql,
+            ordering=json.dumps(registry.get_ordering(data)),
+            report_type=registry.get_report_type(data))
 
     def get_queryset(self):
         # TODO: jeżeli w sesji jest obiekt, którego NIE DA się sparse'ować, to wówczas błąd podnoś i to samo w klasie MultiseekFormPage
-        return get_registry(self.registry).get_query_for_model(
-            self.get_multiseek_data(),
-            self.request.session.get(MULTISEEK_SESSION_KEY_REMOVED, []))
+        registry = get_registry(self.registry)
+
+        with self.phase(PARSE):
+            data = self.get_multiseek_data()
+
+        with self.phase(COMPILE):
+            base_queryset = None
+            self.materialized_form = self.get_materialized_form()
+            if self.materialized_form is not None:
+                base_queryset = \
+                    self.materialized_form.get_materialized_queryset(
+                        registry.model)
+            else:
+                self.job = self.get_job(data)
+                if self.job is not None and self.job['status'] == FAILED:
+                    self.job = None
+                    self.error_message = ERR_SEARCH_JOB_FAILED
+                    return registry.model.objects.none()
+
+                if self.job is not None:
+                    base_queryset = self.get_job_queryset()
+
+            queryset = registry.get_query_for_model(
+                data,
+                self.request.session.get(MULTISEEK_SESSION_KEY_REMOVED, []),
+                base_queryset=base_queryset)
+
+            if base_queryset is None and data.get('form_data'):
+                # Report how relations were joined
+                for strategy in registry.get_join_strategies(
+                        data['form_data']):
+                    self.timings.event(strategy)
+
+        if registry.max_query_cost is not None and base_queryset is None:
+            with self.phase(EXPLAIN):
+                action = registry.get_query_cost_action(queryset)
+
+            if action == COST_REFUSE:
+                self.error_message = ERR_QUERY_TOO_EXPENSIVE
+                return queryset.none()
+
+            if action == COST_LIMIT:
+                self.row_limit = registry.query_cost_row_limit
+                return self.get_page(queryset[:self.row_limit])
+
+            if action == COST_BACKGROUND:
+                self.job = self.start_job(data)
+                return queryset.none()
+
+        if self.job is not None:
+            # Already limited to the page
+            return queryset
+
+        return self.get_page(queryset)
+
+
+def job_status(request, job_id):
+    """Returns status of a background search job, as JSON, so the
+    results page can poll for it."""
+    stored = request.session.get(MULTISEEK_SESSION_KEY_JOB)
+    if stored is None or stored[0] != job_id:
+        return HttpResponseNotFound()
+
+    job = get_job(job_id)
+    if job is None:
+        return HttpResponseNotFound()
+
+    return HttpResponse(simplejson.dumps(job),
+                        content_type="application/json")
 
 
 class MultiseekModelRouter(View):
     registry = None
 
     def get(self, request, model, *args, **kw):
-        registry = get_registry(self.registry)
-        for field in registry.fields:
-            if field.type == AUTOCOMPLETE:
-                if model == field.model.__name__:
-                    return MultiseekModelAutocomplete(original=field).get(request)
-        raise Http404
+        field = get_registry(self.registry).get_autocomplete_field(model)
+        if field is None:
+            raise Http404
+        return MultiseekModelAutocomplete(original=field).get(request)
 
 
 class MultiseekModelAutocomplete(View):
@@ -309,10 +707,8 @@ class MultiseekModelAutocomplete(View):
 
         ret = []
         for elem in qset[:self.max_items]:
-            ret.append(
-                {'id': elem.pk,
-                 'label': self.original.get_autocomplete_label(elem),
-                 'value': self.original.get_autocomplete_label(elem)})
+            label = self.original.get_autocomplete_label(elem)
+            ret.append({'id': elem.pk, 'label': label, 'value': label})
 
         return HttpResponse(simplejson.dumps(ret),
                             content_type='application/json')
@@ -66,7 +66,8 @@ setup(
     author=u'Michał Pasternak',
     author_email='michal.dtz@gmail.com',
     url='http://TODO',
-    packages=['multiseek'],
+    packages=['multiseek', 'multiseek.migrations', 'multiseek.management',
+              'multiseek.management.commands'],
     package_data={'multiseek': [
         'locale/*/LC_MESSAGES/*',
         'static/multiseek/*.js',
@@ -0,0 +1,135 @@
+# -*- encoding: utf-8 -*-
+import json
+import platform
+import time
+from optparse import make_option
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.core.urlresolvers import reverse
+from django.test.client import Client, RequestFactory
+
+from multiseek.logic import get_registry, CONTAINS, EQUAL, RANGE_OPS, AND, \
+    OR
+from multiseek.util import make_field
+from multiseek.views import MultiseekResults, MULTISEEK_SESSION_KEY
+from test_app import multiseek_registry
+from test_app.models import Author, Book
+
+
+class Session(dict):
+    def save(self):
+        return None
+
+
+def sample_form():
+    """Return form data used by every benchmark: a few fields of every
+    type, including a nested frame."""
+    r = multiseek_registry
+    return {
+        'form_data': [
+            None,
+            make_field(r.TitleQueryObject, CONTAINS, u'python', None),
+            make_field(r.YearQueryObject, RANGE_OPS[0], u'[1950,2000]', AND),
+            [OR,
+             make_field(r.LanguageQueryObject, EQUAL, u'english', None),
+             make_field(r.AvailableQueryObject, EQUAL, u'yes', AND)]],
+        'ordering': {'order_0': '1', 'order_1': '3', 'order_1_dir': '1'},
+        'report_type': '0'}
+
+
+def timed(function, repeat):
+    """Call function repeat times, return timings in milliseconds."""
+    timings = []
+    for no in range(repeat):
+        start = time.time()
+        function()
+        timings.append((time.time() - start) * 1000.0)
+    timings.sort()
+    return dict(
+        min=timings[0],
+        median=timings[len(timings) // 2],
+        mean=sum(timings) / len(timings),
+        max=timings[-1],
+        repeat=repeat)
+
+
+class Command(BaseCommand):
+    help = 'Time multiseek query building and views on the current ' \
+           'database (see multiseek_generate_data) and output JSON, ' \
+           'so results can be compared between commits.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--repeat', type='int', default=20,
+                    help='How many times each benchmark is run'),
+        make_option('--output', default=None,
+                    help='Write JSON to this file instead of stdout'),
+        make_option('--label', default='',
+                    help='Free-form label stored with results, like '
+                         'a commit id'),
+    )
+
+    def micro_benchmarks(self, repeat):
+        registry = get_registry(settings.MULTISEEK_REGISTRY)
+        data = sample_form()
+        label = unicode(registry.fields[-1].label)
+
+        request = RequestFactory().get('/')
+        request.session = Session()
+        request.session[MULTISEEK_SESSION_KEY] = json.dumps(data)
+
+        def describe():
+            view = MultiseekResults(registry=registry)
+            view.request = request
+            view.describe_multiseek_data()
+
+        return {
+            'get_query': timed(
+                lambda: registry.get_query(data['form_data']), repeat),
+            'recreate_form': timed(
+                lambda: registry.recreate_form(data), repeat),
+            'describe_multiseek_data': timed(describe, repeat),
+            'get_field_by_name': timed(
+                lambda: registry.get_field_by_name(label), repeat),
+        }
+
+    def view_benchmarks(self, repeat):
+        client = Client()
+        index = reverse('multiseek:index')
+        results = reverse('multiseek:results')
+        autocomplete = index + 'autocomplete/Author/'
+        data = json.dumps(sample_form())
+
+        def post_results():
+            client.post(results, {'json': data})
+
+        return {
+            'form_page': timed(lambda: client.get(index), repeat),
+            'results': timed(post_results, repeat),
+            'results_reload': timed(lambda: client.get(results), repeat),
+            'autocomplete': timed(
+                lambda: client.get(autocomplete, {'term': 'smi'}), repeat),
+        }
+
+    def handle(self, *args, **options):
+        repeat = options['repeat']
+
+        ret = {
+            'label': options['label'],
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': settings.DATABASES['default']['ENGINE'],
+            'rows': {
+                'book': Book.objects.count(),
+                'author': Author.objects.count()},
+            'micro': self.micro_benchmarks(repeat),
+            'views': self.view_benchmarks(repeat)
+        }
+
+        output = json.dumps(ret, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+        else:
+            self.stdout.write(output)
@@ -0,0 +1,123 @@
+# -*- encoding: utf-8 -*-
+import random
+from contextlib import contextmanager
+from datetime import date, timedelta
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from multiseek.models import FacetCount
+from test_app.models import Author, Book, Language
+from test_app.multiseek_registry import registry, AuthorQueryObject
+
+WORDS = [u'book', u'title', u'history', u'django', u'python', u'żółw',
+         u'garden', u'night', u'river', u'secret', u'code', u'winter',
+         u'stone', u'kraków', u'łódź', u'summer', u'query', u'database']
+
+FIRST_NAMES = [u'John', u'Ian', u'Anna', u'Maria', u'Paweł', u'Łukasz',
+               u'Zofia', u'Peter', u'Kate', u'Michał']
+
+LAST_NAMES = [u'Smith', u'Kovalsky', u'Nowak', u'Wiśniewski', u'Brown',
+              u'Zieliński', u'Taylor', u'Lewandowska', u'Jones', u'Wójcik']
+
+LANGUAGES = [u'english', u'polish', u'german', u'french', u'spanish']
+
+
+@contextmanager
+def without_auto_now(model, field_name):
+    """Keep values of an auto_now field of the model given when saving,
+    instead of replacing them with the current date."""
+    field = model._meta.get_field(field_name)
+    auto_now = field.auto_now
+    field.auto_now = False
+    try:
+        yield
+    finally:
+        field.auto_now = auto_now
+
+
+class Command(BaseCommand):
+    args = '<number of books>'
+    help = 'Fill the database with random books, authors and languages, ' \
+           'for benchmarking multiseek with 10^4 - 10^7 rows.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--seed', type='int', default=0,
+                    help='Random seed, so the data can be reproduced'),
+        make_option('--batch-size', type='int', default=10000,
+                    help='Number of rows inserted at once'),
+        make_option('--authors-per-book', type='int', default=2,
+                    dest='authors_per_book'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Please give the number of books to create")
+
+        try:
+            no_books = int(args[0])
+        except ValueError:
+            raise CommandError("Number of books must be an integer")
+
+        rnd = random.Random(options['seed'])
+        batch_size = options['batch_size']
+
+        with transaction.atomic(), without_auto_now(Book, 'last_updated'):
+            languages = []
+            for name in LANGUAGES:
+                lang, created = Language.objects.get_or_create(
+                    name=name, defaults=dict(description=name.title()))
+                languages.append(lang.pk)
+
+            no_authors = max(no_books // 10, 100)
+            for start in range(0, no_authors, batch_size):
+                authors = [
+                    Author(first_name=rnd.choice(FIRST_NAMES),
+                           last_name=rnd.choice(LAST_NAMES))
+                    for x in range(start, min(start + batch_size,
+                                              no_authors))]
+                for author in authors:
+                    AuthorQueryObject().normalize_record(author)
+                Author.objects.bulk_create(authors)
+            authors = list(Author.objects.values_list('pk', flat=True))
+
+            through = Book.authors.through
+            first_day = date(1990, 1, 1)
+
+            for start in range(0, no_books, batch_size):
+                count = min(batch_size, no_books - start)
+                last_pk = Book.objects.order_by('-pk').values_list(
+                    'pk', flat=True).first() or 0
+
+                books = [
+                    Book(title=u" ".join(rnd.sample(WORDS, 3)),
+                         year=rnd.randint(1900, 2015),
+                         language_id=rnd.choice(languages),
+                         no_editors=rnd.randint(0, 10),
+                         last_updated=first_day + timedelta(
+                             days=rnd.randint(0, 9000)),
+                         available=rnd.random() > 0.5)
+                    for x in range(count)]
+
+                # bulk_create skips signal handlers filling normalized fields
+                for book in books:
+                    registry.normalize_record(book)
+                Book.objects.bulk_create(books)
+
+                # bulk_create does not return primary keys on every
+                # database backend, so fetch them
+                pks = Book.objects.filter(pk__gt=last_pk).values_list(
+                    'pk', flat=True)
+
+                through.objects.bulk_create([
+                    through(book_id=pk, author_id=author)
+                    for pk in pks
+                    for author in set(rnd.sample(
+                        authors, options['authors_per_book']))])
+
+                self.stdout.write(u"%i of %i books" % (start + count,
+                                                       no_books))
+
+        # bulk_create skips signal handlers updating facet counts, too
+        FacetCount.objects.rebuild(registry)
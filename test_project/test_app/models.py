@@ -11,6 +11,8 @@ class Language(models.Model):
 class Author(models.Model):
     last_name = models.TextField()
     first_name = models.TextField()
+    last_name_normalized = models.TextField(blank=True)
+    first_name_normalized = models.TextField(blank=True)
 
     def __unicode__(self):
         return u"%s %s" % (self.first_name, self.last_name)
@@ -18,6 +20,7 @@ class Author(models.Model):
 
 class Book(models.Model):
     title = models.TextField()
+    title_normalized = models.TextField(blank=True, db_index=True)
     year = models.IntegerField()
     language = models.ForeignKey(Language)
     authors = models.ManyToManyField(Author)
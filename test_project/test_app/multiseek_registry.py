@@ -4,12 +4,14 @@ from django.utils.translation import ugettext_lazy as _
 from multiseek.logic import Ordering, ReportType, DateQueryObject, \
     AutocompleteQueryObject, StringQueryObject, RangeQueryObject, \
     create_registry, ValueListQueryObject, IntegerQueryObject, \
-    BooleanQueryObject
+    BooleanQueryObject, RELEVANCE
+from multiseek.models import connect_registry_signals
 from test_app.models import Author, Book, Language
 
 
 class TitleQueryObject(StringQueryObject):
     field_name = 'title'
+    normalized_field_name = 'title_normalized'
     label = _("Title")
 
 
@@ -18,6 +20,8 @@ class AuthorQueryObject(AutocompleteQueryObject):
     model = Author
     field_name = "authors"
     search_fields = ['first_name', 'last_name']
+    normalized_search_fields = ['first_name_normalized',
+                                'last_name_normalized']
 
 
 class YearQueryObject(RangeQueryObject):
@@ -29,6 +33,7 @@ class LanguageQueryObject(ValueListQueryObject):
     field_name = 'language__name'
     values = Language.objects.all()
     label = _("Language")
+    facet = True
 
 
 class CostQueryObject(IntegerQueryObject):
@@ -44,6 +49,7 @@ class DateLastUpdatedQueryObject(DateQueryObject):
 class AvailableQueryObject(BooleanQueryObject):
     field_name = "available"
     label = _("Available")
+    facet = True
 
 registry = create_registry(
     Book,
@@ -59,10 +65,15 @@ registry = create_registry(
         Ordering("title", _("title")),
         Ordering("authors", _("author")),
         Ordering("year", _("year")),
+        Ordering(RELEVANCE, _("relevance")),
     ],
     default_ordering=['-title', 'authors', 'year'],
     report_types=[
         ReportType("list", _("list")),
         ReportType("table", _("table")),
         ReportType("secret", _("secret"), public=False)
-    ])
\ No newline at end of file
+    ],
+    facet_rollup=True,
+    cache_rows=True)
+
+connect_registry_signals(registry)